@@ -0,0 +1,265 @@
+# benchmarks/bench_dialog.py
+"""Сквозной бенчмарк диалогов: вложение → сумма → примечание → заказ → выбор.
+
+Обновления подаются в настоящий router из bot.handlers через Dispatcher;
+Telegram заменён фейковой сессией, Airtable — локальным aiohttp-сервером
+с настраиваемой задержкой и долей ошибок.
+
+Запуск: python -m benchmarks.bench_dialog [--users 20] [--dialogs 10] [--latency 0.2] [--error-rate 0.05]
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import statistics
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List
+
+USER_ID_BASE = 1000
+
+
+def percentile(values: List[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+async def start_airtable_stub(latency: float, error_rate: float, stats: Dict[str, int]):
+    """Локальная замена Airtable: создание записей, PATCH и uploadAttachment."""
+    from aiohttp import web
+
+    record_ids = itertools.count(1)
+    rnd = random.Random(3)
+
+    async def respond(request: web.Request, build):
+        await request.read()
+        if latency:
+            await asyncio.sleep(latency)
+        if rnd.random() < error_rate:
+            stats["errors"] += 1
+            return web.json_response({"error": {"message": "stub failure"}}, status=503)
+        return web.json_response(build())
+
+    async def create(request: web.Request):
+        body = await request.json() if request.can_read_body else {}
+        records = body.get("records", [])
+
+        def build():
+            stats["records"] += len(records)
+            stats["requests"] += 1
+            return {"records": [{"id": f"rec{next(record_ids)}", "fields": r.get("fields", {})} for r in records]}
+
+        return await respond(request, build)
+
+    async def other(request: web.Request):
+        def build():
+            stats["requests"] += 1
+            if request.path.endswith("/uploadAttachment"):
+                stats["uploads"] += 1
+            return {"id": request.match_info.get("record", "rec"), "fields": {}}
+
+        return await respond(request, build)
+
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app.router.add_post("/v0/{base}/{table}", create)
+    app.router.add_patch("/v0/{base}/{table}/{record}", other)
+    app.router.add_post("/v0/{base}/{record}/{field}/uploadAttachment", other)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}"
+
+
+def make_fake_session():
+    from aiogram.client.session.base import BaseSession
+    from aiogram.methods import AnswerCallbackQuery, GetFile, SendMessage
+    from aiogram.types import Chat, File, Message
+
+    class FakeTelegramSession(BaseSession):
+        """Сессия Bot API без сети: отвечает на запросы бота и запоминает отправленное."""
+
+        def __init__(self, file_size: int):
+            super().__init__()
+            self.file_size = file_size
+            self.last_markup: Dict[int, Any] = {}
+            self.confirmations: Dict[int, asyncio.Queue] = defaultdict(asyncio.Queue)
+            self.requests = 0
+            self._message_ids = itertools.count(1)
+
+        async def make_request(self, bot, method, timeout=None):
+            self.requests += 1
+            if isinstance(method, SendMessage):
+                chat_id = int(method.chat_id)
+                if method.reply_markup is not None and hasattr(method.reply_markup, "inline_keyboard"):
+                    self.last_markup[chat_id] = method.reply_markup
+                if method.text.startswith("✅"):
+                    self.confirmations[chat_id].put_nowait(time.perf_counter())
+                return Message(
+                    message_id=next(self._message_ids),
+                    date=datetime.now(),
+                    chat=Chat(id=chat_id, type="private"),
+                    text=method.text
+                )
+            if isinstance(method, GetFile):
+                return File(
+                    file_id=method.file_id,
+                    file_unique_id=method.file_id,
+                    file_size=self.file_size,
+                    file_path=f"documents/{method.file_id}.pdf"
+                )
+            if isinstance(method, AnswerCallbackQuery):
+                return True
+            return True
+
+        async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+            remaining = self.file_size
+            while remaining > 0:
+                size = min(chunk_size, remaining)
+                remaining -= size
+                yield b"\0" * size
+
+        async def close(self):
+            pass
+
+    return FakeTelegramSession
+
+
+async def run(args):
+    # synthetic задаёт заглушки настроек — импортируется раньше модулей бота
+    from .synthetic import CatalogModel, queries_for
+    from aiogram import Bot, Dispatcher
+    from aiogram.fsm.storage.memory import MemoryStorage
+    import bot.airtable_client as airtable_module
+    from bot.fsm_storage import SQLiteStorage
+    from bot.handlers import router, airtable_client, orders_cache, outbox, payments_replica, attachment_uploader
+    from bot.rate_limiter import RateLimiter
+
+    stats: Dict[str, int] = defaultdict(int)
+    runner, stub_url = await start_airtable_stub(args.latency, args.error_rate, stats)
+    tmp = Path(tempfile.mkdtemp(prefix="bench_dialog_"))
+
+    # Направляем клиента Airtable и очередь оплат на заглушку и временный каталог
+    airtable_client.base_url = f"{stub_url}/v0/appBenchmark/tblPayments"
+    airtable_module.CONTENT_API_URL = f"{stub_url}/v0"
+    airtable_client.limiter = RateLimiter(args.airtable_rps, max(1, int(args.airtable_rps)))
+    outbox.path = tmp / "outbox.sqlite3"
+    payments_replica.path = tmp / "payments.sqlite3"
+
+    names = CatalogModel.from_cache().catalog(args.orders)
+    now = time.time()
+    orders_cache._set_records({f"rec{i}": name for i, name in enumerate(names)}, now, now)
+    queries = queries_for(names, 1000)
+
+    session = make_fake_session()(args.file_size)
+    bot = Bot(token="42:BENCHMARK", session=session)
+    storage = SQLiteStorage(tmp / "fsm.sqlite3") if args.storage == "sqlite" else MemoryStorage()
+    dp = Dispatcher(storage=storage)
+    dp.include_router(router)
+
+    await airtable_client.start()
+    attachment_uploader.start(bot, on_done=outbox.attachments_done, on_uploaded=outbox.attachment_uploaded)
+    outbox.start()
+
+    update_ids = itertools.count(1)
+    update_latencies: List[float] = []
+    dialog_latencies: List[float] = []
+
+    async def feed(update: Dict[str, Any]):
+        update["update_id"] = next(update_ids)
+        started = time.perf_counter()
+        await dp.feed_raw_update(bot, update)
+        update_latencies.append((time.perf_counter() - started) * 1000)
+
+    def message(user_id: int, **content) -> Dict[str, Any]:
+        return {"message": {
+            "message_id": 1,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Bench", "last_name": str(user_id)},
+            **content
+        }}
+
+    async def user_session(user_id: int, rnd: random.Random):
+        for n in range(args.dialogs):
+            started = time.perf_counter()
+            await feed(message(user_id, document={
+                "file_id": f"f{user_id}_{n}",
+                "file_unique_id": f"u{user_id}_{n}",
+                "file_name": "check.pdf",
+                "mime_type": "application/pdf",
+                "file_size": args.file_size
+            }))
+            await feed(message(user_id, text=f"{rnd.randint(100, 99999)}"))
+            await feed(message(user_id, text="бенчмарк"))
+            session.last_markup.pop(user_id, None)
+            await feed(message(user_id, text=rnd.choice(queries)))
+            markup = session.last_markup.get(user_id)
+            if markup is not None:
+                buttons = [row[0] for row in markup.inline_keyboard if row[0].callback_data.startswith("order:")]
+                button = rnd.choice(buttons)
+                await feed({"callback_query": {
+                    "id": str(next(update_ids)),
+                    "from": {"id": user_id, "is_bot": False, "first_name": "Bench"},
+                    "chat_instance": "bench",
+                    "data": button.callback_data,
+                    "message": message(user_id, text="Выберите заказ:")["message"]
+                }})
+            confirmed_at = await session.confirmations[user_id].get()
+            dialog_latencies.append((confirmed_at - started) * 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        user_session(USER_ID_BASE + i, random.Random(i)) for i in range(args.users)
+    ))
+    elapsed = time.perf_counter() - started
+
+    # Ждём, пока очередь оплат и вложения дойдут до заглушки Airtable
+    drain_started = time.perf_counter()
+    expected = args.users * args.dialogs
+    while (stats["records"] < expected or attachment_uploader._tasks) and time.perf_counter() - drain_started < args.drain_timeout:
+        await asyncio.sleep(0.05)
+    drain = time.perf_counter() - drain_started
+
+    print(f"Диалогов: {expected}, обновлений: {len(update_latencies)}, за {elapsed:.2f} с")
+    print(f"Пропускная способность: {len(update_latencies) / elapsed:.1f} обновлений/с, {expected / elapsed:.1f} диалогов/с")
+    print(f"Обработка обновления, мс: p50 {percentile(update_latencies, 50):.2f}, p99 {percentile(update_latencies, 99):.2f}")
+    print(f"Диалог до подтверждения, мс: p50 {percentile(dialog_latencies, 50):.1f}, "
+          f"p99 {percentile(dialog_latencies, 99):.1f}, среднее {statistics.fmean(dialog_latencies):.1f}")
+    print(f"Airtable: записей {stats['records']}/{expected}, запросов {stats['requests']}, "
+          f"загрузок {stats['uploads']}, ошибок {stats['errors']}, досылка очереди {drain:.2f} с")
+    print(f"Лимитер: {airtable_client.limiter.stats}")
+
+    await outbox.stop()
+    await payments_replica.stop()
+    await attachment_uploader.stop()
+    await airtable_client.close()
+    await storage.close()
+    await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20, help="одновременных пользователей")
+    parser.add_argument("--dialogs", type=int, default=10, help="диалогов на пользователя")
+    parser.add_argument("--orders", type=int, default=5000, help="размер синтетического каталога заказов")
+    parser.add_argument("--latency", type=float, default=0.2, help="задержка ответа Airtable, с")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 503 от Airtable")
+    parser.add_argument("--airtable-rps", type=float, default=50, help="лимит запросов к заглушке в секунду")
+    parser.add_argument("--file-size", type=int, default=200 * 1024, help="размер вложения, байт")
+    parser.add_argument("--storage", choices=["memory", "sqlite"], default="memory")
+    parser.add_argument("--drain-timeout", type=float, default=60, help="сколько ждать досылки очереди, с")
+    args = parser.parse_args()
+
+    # Пользователи бенчмарка должны пройти проверку is_authorized
+    os.environ["AUTHORIZED_USERS"] = ",".join(str(USER_ID_BASE + i) for i in range(args.users))
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+# benchmarks/bench_search.py
+"""Бенчмарк поиска заказов на синтетических каталогах.
+
+Запуск: python -m benchmarks.bench_search [--sizes 1000 10000 100000 1000000] [--baseline]
+"""
+import argparse
+import gc
+import statistics
+import time
+import tracemalloc
+from typing import Callable, List
+from .synthetic import CatalogModel, queries_for
+from rapidfuzz import process as fuzz_process, fuzz
+from bot.order_index import OrderIndex, SCORE_CUTOFF
+
+
+def legacy_search(names: List[str]) -> Callable[[str], List[str]]:
+    """Прежний алгоритм из process_order: полный проход extract() по каждому токену."""
+    def search(query: str) -> List[str]:
+        orders_lower = [name.lower() for name in names]
+        results = []
+        for token in query.lower().split():
+            matches = fuzz_process.extract(
+                token, orders_lower, scorer=fuzz.partial_ratio, score_cutoff=SCORE_CUTOFF, limit=None
+            )
+            results.append({match[2] for match in matches})
+        indices = results[0].intersection(*results[1:]) if results else set()
+        return [names[i] for i in indices]
+    return search
+
+
+def percentile(values: List[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def measure(search: Callable[[str], List[str]], queries: List[str]):
+    latencies = []
+    found = 0
+    for query in queries:
+        started = time.perf_counter()
+        found += len(search(query))
+        latencies.append((time.perf_counter() - started) * 1000)
+    return latencies, found / len(queries)
+
+
+def run(sizes: List[int], query_count: int, baseline: bool, track_memory: bool):
+    model = CatalogModel.from_cache()
+    print(f"{'size':>9} {'impl':>8} {'build ms':>9} {'mem MB':>7} {'p50 ms':>8} {'p99 ms':>8} {'mean ms':>8} {'hits':>6}")
+    for size in sizes:
+        names = model.catalog(size)
+        queries = queries_for(names, query_count)
+
+        memory_mb = 0.0
+        if track_memory:
+            # Память считается на отдельной сборке: tracemalloc сильно замедляет аллокации
+            gc.collect()
+            tracemalloc.start()
+            index = OrderIndex(names)
+            memory_mb = tracemalloc.get_traced_memory()[0] / 2 ** 20
+            tracemalloc.stop()
+            del index
+        gc.collect()
+        started = time.perf_counter()
+        index = OrderIndex(names)
+        build_ms = (time.perf_counter() - started) * 1000
+
+        impls = [("index", index.search, build_ms, memory_mb)]
+        if baseline:
+            impls.append(("legacy", legacy_search(names), 0.0, 0.0))
+        for label, search, build, memory in impls:
+            latencies, hits = measure(search, queries)
+            print(f"{size:>9} {label:>8} {build:>9.1f} {memory:>7.1f} {percentile(latencies, 50):>8.2f} "
+                  f"{percentile(latencies, 99):>8.2f} {statistics.fmean(latencies):>8.2f} {hits:>6.1f}")
+        del index, names
+        gc.collect()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000, 1000000])
+    parser.add_argument("--queries", type=int, default=200, help="число запросов на каждый размер")
+    parser.add_argument("--baseline", action="store_true", help="сравнить с прежним полным перебором")
+    parser.add_argument("--no-memory", action="store_true", help="не измерять память индекса")
+    args = parser.parse_args()
+    run(args.sizes, args.queries, args.baseline, not args.no_memory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+# benchmarks/synthetic.py
+import json
+import os
+import random
+import re
+from collections import Counter
+from pathlib import Path
+from typing import List
+
+# Модули бота читают настройки при импорте — для бенчмарков хватает заглушек
+for _name, _value in {
+    "TELEGRAM_BOT_TOKEN": "42:BENCHMARK",
+    "AIRTABLE_API_KEY": "benchmark",
+    "AIRTABLE_BASE_ID": "appBenchmark",
+    "AIRTABLE_TABLE_ID": "tblPayments",
+    "AIRTABLE_ORDERS_TABLE_ID": "tblOrders",
+    "AUTHORIZED_USERS": "1"
+}.items():
+    os.environ.setdefault(_name, _value)
+
+ORDERS_FILE = Path(__file__).parent.parent / "cache" / "orders_cache.json"
+ORDER_RE = re.compile(r"^([A-ZА-ЯЁ]{2,4})-(\d{3,6})((?:-\d+)*)\s*(.*)$")
+
+
+class CatalogModel:
+    """Статистика реальных названий заказов: префиксы кодов, длины номеров, слова."""
+
+    def __init__(self, names: List[str]):
+        self.prefixes = Counter()
+        self.number_lengths = Counter()
+        self.suffix_rate = 0.0
+        self.words: List[str] = []
+        self.tail_lengths = Counter()
+        suffixes = 0
+        for name in names:
+            match = ORDER_RE.match(name)
+            if not match:
+                continue
+            prefix, number, suffix, tail = match.groups()
+            self.prefixes[prefix] += 1
+            self.number_lengths[len(number)] += 1
+            suffixes += bool(suffix)
+            tail_words = tail.split()
+            self.words.extend(tail_words)
+            self.tail_lengths[len(tail_words)] += 1
+        self.suffix_rate = suffixes / max(1, sum(self.prefixes.values()))
+
+    @classmethod
+    def from_cache(cls, path: Path = ORDERS_FILE) -> "CatalogModel":
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        names = data.get("orders") or list((data.get("records") or {}).values())
+        return cls(names)
+
+    def _pick(self, rnd: random.Random, counter: Counter):
+        return rnd.choices(list(counter), weights=list(counter.values()))[0]
+
+    def name(self, rnd: random.Random) -> str:
+        digits = self._pick(rnd, self.number_lengths)
+        code = f"{self._pick(rnd, self.prefixes)}-{rnd.randrange(10 ** digits):0{digits}d}"
+        if rnd.random() < self.suffix_rate:
+            code += f"-{rnd.randint(2, 5)}"
+        tail = rnd.choices(self.words, k=self._pick(rnd, self.tail_lengths)) if self.words else []
+        return " ".join([code, *tail])
+
+    def catalog(self, size: int, seed: int = 1) -> List[str]:
+        rnd = random.Random(seed)
+        return [self.name(rnd) for _ in range(size)]
+
+
+def queries_for(names: List[str], count: int, seed: int = 2) -> List[str]:
+    """Запросы, похожие на то, что вводят пользователи: код, номер, слово, код + слово."""
+    rnd = random.Random(seed)
+    queries = []
+    for _ in range(count):
+        name = rnd.choice(names)
+        code, *words = name.split()
+        prefix, _, number = code.partition("-")
+        kind = rnd.random()
+        if kind < 0.3:
+            query = f"{prefix} {number.split('-')[0]}"
+        elif kind < 0.5:
+            query = number.split("-")[0]
+        elif kind < 0.8 and words:
+            query = rnd.choice(words)
+        elif words:
+            query = f"{prefix} {rnd.choice(words)}"
+        else:
+            query = code
+        if rnd.random() < 0.2 and len(query) > 4:
+            # Опечатка: одна заменённая буква
+            i = rnd.randrange(len(query))
+            query = query[:i] + rnd.choice("аеиоу") + query[i + 1:]
+        queries.append(query.lower())
+    return queries
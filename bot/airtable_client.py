@@ -1,82 +1,324 @@
 # bot/airtable_client.py
 import httpx
 import asyncio
+import base64
+import json
 import logging
-from typing import Dict, Any, List
+import random
+import time
+from datetime import datetime, timezone
+from urllib.parse import quote
+from typing import Dict, Any, AsyncIterator, Awaitable, Callable, List, Optional
 from .config import (
     AIRTABLE_API_KEY,
     AIRTABLE_BASE_ID,
     AIRTABLE_TABLE_ID,
-    AIRTABLE_ORDERS_TABLE_ID
+    AIRTABLE_ORDERS_TABLE_ID,
+    AIRTABLE_HTTP2,
+    AIRTABLE_TIMEOUT,
+    AIRTABLE_CONNECT_TIMEOUT,
+    AIRTABLE_MAX_CONNECTIONS,
+    AIRTABLE_MAX_KEEPALIVE,
+    AIRTABLE_KEEPALIVE_EXPIRY,
+    AIRTABLE_MAX_ATTEMPTS
 )
+from .rate_limiter import RateLimiter, airtable_limiter, PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND
+from .metrics import AIRTABLE_RETRIES, AIRTABLE_SECONDS
 
 logger = logging.getLogger(__name__)
 
+# Ограничение Airtable на количество записей в одном запросе на запись
+MAX_RECORDS_PER_REQUEST = 10
+
+# Загрузка файлов напрямую в поле-вложение (content API Airtable)
+CONTENT_API_URL = "https://content.airtable.com/v0"
+MAX_UPLOAD_SIZE = 5 * 1024 * 1024
+
+# Экспоненциальная задержка между повторами (с jitter) и пауза после 429 без Retry-After
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30.0
+RATE_LIMIT_PENALTY = 30.0
+
+# Поля таблицы оплат, которые выгружаются в локальную реплику
+PAYMENT_FIELDS = ("Отправитель", "Сумма", "Заказ", "Примечание")
+
+# Заказы в этих статусах не предлагаются при поиске
+INACTIVE_ORDER_STATUSES = {"Расчет", "Отменен", "Отложен"}
+
+
+# on_created(records) — записи таблицы оплат, только что созданные в Airtable (id, createdTime, fields)
+CreatedCallback = Callable[[List[Dict[str, Any]]], Awaitable[None]]
+
+
+class AirtableError(Exception):
+    """Ошибка Airtable; status_code есть только у ответов API (для сетевых ошибок — None)."""
+
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+    @property
+    def is_permanent(self) -> bool:
+        # 4xx (кроме 429) — ошибка в самих данных, повтор не поможет
+        return self.status_code is not None and 400 <= self.status_code < 500 and self.status_code != 429
+
+
+def is_active_order(record: Dict[str, Any]) -> bool:
+    return bool(record.get("name")) and record.get("status") not in INACTIVE_ORDER_STATUSES
+
+
+def _retry_after(response: httpx.Response) -> Optional[float]:
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
+
+
+def _backoff(attempt: int) -> float:
+    # Full jitter: случайная задержка от 0 до base * 2^attempt
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
 
 class AirtableClient:
-    def __init__(self):
+    def __init__(self, limiter: RateLimiter = airtable_limiter):
+        self.limiter = limiter
         self.base_url = f"https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{AIRTABLE_TABLE_ID}"
+        self.orders_url = f"https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{AIRTABLE_ORDERS_TABLE_ID}"
         self.headers = {
             "Authorization": f"Bearer {AIRTABLE_API_KEY}",
             "Content-Type": "application/json"
         }
+        self._http: Optional[httpx.AsyncClient] = None
+        # Write-through в локальную реплику оплат (PaymentsReplica)
+        self.on_created: Optional[CreatedCallback] = None
+
+    async def start(self):
+        """Открывает общий пул соединений к api.airtable.com (keep-alive, опционально HTTP/2)."""
+        if self._http is not None and not self._http.is_closed:
+            return
+        http2 = AIRTABLE_HTTP2
+        if http2 and not _http2_available():
+            logger.warning("AIRTABLE_HTTP2 включён, но пакет h2 не установлен — используется HTTP/1.1")
+            http2 = False
+        self._http = httpx.AsyncClient(
+            headers=self.headers,
+            http2=http2,
+            timeout=httpx.Timeout(AIRTABLE_TIMEOUT, connect=AIRTABLE_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=AIRTABLE_MAX_CONNECTIONS,
+                max_keepalive_connections=AIRTABLE_MAX_KEEPALIVE,
+                keepalive_expiry=AIRTABLE_KEEPALIVE_EXPIRY
+            )
+        )
+        logger.info(f"HTTP-клиент Airtable открыт (http2={http2}, max_connections={AIRTABLE_MAX_CONNECTIONS})")
+
+    async def close(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+            logger.info("HTTP-клиент Airtable закрыт")
+
+    async def _client(self) -> httpx.AsyncClient:
+        # Если start() не вызывали (например, при запуске вне бота) — открываем пул лениво
+        if self._http is None or self._http.is_closed:
+            await self.start()
+        return self._http
+
+    async def _request(self, method: str, url: str, priority: int = PRIORITY_INTERACTIVE,
+                       content_factory: Optional[Callable[[], AsyncIterator[bytes]]] = None,
+                       **kwargs) -> httpx.Response:
+        """Запрос через общий лимитер с повтором при сетевых ошибках, 429 и 5xx.
+
+        Потоковое тело передаётся через content_factory: для каждой попытки
+        создаётся новый поток.
+        """
+        for attempt in range(AIRTABLE_MAX_ATTEMPTS):
+            last_attempt = attempt == AIRTABLE_MAX_ATTEMPTS - 1
+            await self.limiter.acquire(priority)
+            if content_factory is not None:
+                kwargs["content"] = content_factory()
+            started = time.perf_counter()
+            try:
+                client = await self._client()
+                response = await client.request(method, url, **kwargs)
+            except (httpx.NetworkError, httpx.TimeoutException) as e:
+                AIRTABLE_SECONDS.observe(time.perf_counter() - started, method, "network_error")
+                reason = "network_error"
+                if last_attempt:
+                    raise AirtableError(f"Airtable не отвечает после {AIRTABLE_MAX_ATTEMPTS} попыток: {str(e)}")
+                delay = _backoff(attempt)
+                logger.warning(f"Попытка {attempt + 1} не удалась, повтор через {delay:.1f} сек: {e}")
+            except Exception as e:
+                raise AirtableError(f"Неожиданная ошибка: {str(e)}")
+            else:
+                status = response.status_code
+                AIRTABLE_SECONDS.observe(time.perf_counter() - started, method, str(status))
+                reason = str(status)
+                if status != 429 and status < 500:
+                    try:
+                        response.raise_for_status()
+                    except httpx.HTTPStatusError as e:
+                        try:
+                            error_data = e.response.json()
+                            error_message = error_data.get("error", {}).get("message", str(e))
+                        except Exception:
+                            error_message = e.response.text or str(e)
+                        raise AirtableError(f"Airtable API Error: {error_message}", status)
+                    return response
+                if last_attempt:
+                    raise AirtableError(f"Airtable API Error: HTTP {status} после {AIRTABLE_MAX_ATTEMPTS} попыток", status)
+                delay = _retry_after(response)
+                if status == 429:
+                    # Airtable блокирует базу целиком — притормаживаем все запросы процесса
+                    delay = RATE_LIMIT_PENALTY if delay is None else delay
+                    self.limiter.pause(delay)
+                elif delay is None:
+                    delay = _backoff(attempt)
+                logger.warning(f"Airtable ответил {status}, повтор через {delay:.1f} сек")
+            self.limiter.stats["retried"] += 1
+            AIRTABLE_RETRIES.inc(reason)
+            await asyncio.sleep(delay)
 
     async def create_record(self, fields: Dict[str, Any]) -> Dict:
+        return await self.create_records([fields])
+
+    async def create_records(self, records: List[Dict[str, Any]], priority: int = PRIORITY_INTERACTIVE) -> Dict:
+        """Создаёт до MAX_RECORDS_PER_REQUEST записей одним запросом."""
+        if len(records) > MAX_RECORDS_PER_REQUEST:
+            raise ValueError(f"Airtable принимает не больше {MAX_RECORDS_PER_REQUEST} записей за запрос")
         payload = {
-            "records": [{"fields": fields}]
+            "records": [{"fields": fields} for fields in records]
         }
-        for attempt in range(3):
+        response = await self._request("POST", self.base_url, priority=priority, json=payload)
+        data = response.json()
+        if self.on_created is not None:
             try:
-                async with httpx.AsyncClient(timeout=20.0) as client:
-                    response = await client.post(self.base_url, json=payload, headers=self.headers)
-                    response.raise_for_status()
-                    return response.json()
-            except (httpx.NetworkError, httpx.TimeoutException) as e:
-                if attempt == 2:
-                    raise Exception(f"Airtable не отвечает после 3 попыток: {str(e)}")
-                logger.warning(f"Попытка {attempt + 1} не удалась, повтор через 1 сек: {e}")
-                await asyncio.sleep(1)
-            except httpx.HTTPStatusError as e:
-                try:
-                    error_data = e.response.json()
-                    error_message = error_data.get("error", {}).get("message", str(e))
-                except Exception:
-                    error_message = e.response.text or str(e)
-                raise Exception(f"Airtable API Error: {error_message}")
+                await self.on_created(data.get("records", []))
             except Exception as e:
-                raise Exception(f"Неожиданная ошибка: {str(e)}")
+                # Запись в Airtable уже создана; реплику догонит ближайшая синхронизация
+                logger.warning(f"Не удалось записать созданные записи в реплику: {e}")
+        return data
+
+    async def upload_attachment(self, record_id: str, field: str, filename: str, content_type: str,
+                                size: int, open_stream: Callable[[], AsyncIterator[bytes]]) -> Dict:
+        """Загружает файл в поле-вложение записи (до MAX_UPLOAD_SIZE байт).
+
+        Airtable принимает файл в base64 внутри JSON; тело собирается потоком
+        из open_stream() и не держится в памяти целиком.
+        """
+        if size > MAX_UPLOAD_SIZE:
+            raise ValueError(f"Airtable принимает для загрузки файлы до {MAX_UPLOAD_SIZE} байт")
+        prefix = (
+            f'{{"contentType": {json.dumps(content_type)}, "filename": {json.dumps(filename)}, "file": "'
+        ).encode("utf-8")
+        suffix = b'"}'
+
+        async def body() -> AsyncIterator[bytes]:
+            yield prefix
+            rest = b""
+            async for chunk in open_stream():
+                data = rest + chunk
+                cut = len(data) - len(data) % 3
+                rest = data[cut:]
+                if cut:
+                    yield base64.b64encode(data[:cut])
+            if rest:
+                yield base64.b64encode(rest)
+            yield suffix
+
+        url = f"{CONTENT_API_URL}/{AIRTABLE_BASE_ID}/{record_id}/{quote(field)}/uploadAttachment"
+        headers = {
+            "Content-Type": "application/json",
+            "Content-Length": str(len(prefix) + 4 * ((size + 2) // 3) + len(suffix))
+        }
+        response = await self._request("POST", url, content_factory=body, headers=headers)
+        return response.json()
 
-    async def get_order_names(self) -> List[str]:
+    @staticmethod
+    def _modified_since_formula(modified_since: float, *fields: str) -> str:
+        """filterByFormula для дельта-выгрузки: записи, созданные после modified_since
+        или изменённые после него (в полях fields, а без них — в любом поле)."""
+        since = datetime.fromtimestamp(modified_since, tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+        watched = ", ".join(f"{{{field}}}" for field in fields)
+        return (
+            f"OR(IS_AFTER(LAST_MODIFIED_TIME({watched}), DATETIME_PARSE('{since}')), "
+            f"IS_AFTER(CREATED_TIME(), DATETIME_PARSE('{since}')))"
+        )
+
+    async def get_order_records(self, modified_since: Optional[float] = None) -> List[Dict[str, Any]]:
+        """Выгружает заказы из Airtable.
+
+        Без modified_since — только активные заказы (статус фильтруется на стороне Airtable).
+        С modified_since — все заказы, у которых Name или Статус менялись после этого
+        момента, включая ушедшие в неактивные статусы, чтобы кэш мог их удалить.
+        """
         if not AIRTABLE_ORDERS_TABLE_ID:
             raise ValueError("AIRTABLE_ORDERS_TABLE_ID не настроен")
 
-        url = f"https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{AIRTABLE_ORDERS_TABLE_ID}"
-        names = []
+        if modified_since is None:
+            formula = "AND(" + ", ".join(
+                f"{{Статус}} != '{status}'" for status in sorted(INACTIVE_ORDER_STATUSES)
+            ) + ")"
+        else:
+            formula = self._modified_since_formula(modified_since, "Name", "Статус")
+
+        records = []
         offset = None
 
-        async with httpx.AsyncClient(timeout=20.0) as client:
-            while True:
-                # Запрашиваем Name и Статус
-                params = {"fields[]": ["Name", "Статус"]}
-                if offset:
-                    params["offset"] = offset
-
-                response = await client.get(url, headers=self.headers, params=params)
-                response.raise_for_status()
-                data = response.json()
-
-                for record in data.get("records", []):
-                    fields = record.get("fields", {})
-                    name = fields.get("Name")
-                    status = fields.get("Статус")
-                    # Пропускаем, если статус "Расчет" или "Отменен"
-                    if isinstance(status, str) and status.strip() in {"Расчет", "Отменен", "Отложен"}:
-                        continue
-                    if name and isinstance(name, str):
-                        names.append(name.strip())
-
-                offset = data.get("offset")
-                if not offset:
-                    break
-
-        return names
+        while True:
+            # Запрашиваем Name и Статус
+            params = {"fields[]": ["Name", "Статус"], "filterByFormula": formula}
+            if offset:
+                params["offset"] = offset
+
+            response = await self._request("GET", self.orders_url, priority=PRIORITY_BACKGROUND, params=params)
+            data = response.json()
+
+            for record in data.get("records", []):
+                fields = record.get("fields", {})
+                name = fields.get("Name")
+                status = fields.get("Статус")
+                records.append({
+                    "id": record.get("id"),
+                    "name": name.strip() if isinstance(name, str) else "",
+                    "status": status.strip() if isinstance(status, str) else ""
+                })
+
+            offset = data.get("offset")
+            if not offset:
+                break
+
+        return records
+
+    async def get_payment_records(self, modified_since: Optional[float] = None) -> List[Dict[str, Any]]:
+        """Выгружает оплаты (id, createdTime, fields) для локальной реплики.
+
+        Без modified_since — всю таблицу. С modified_since — только записи,
+        созданные или изменённые после этого момента.
+        """
+        params: Dict[str, Any] = {"fields[]": list(PAYMENT_FIELDS), "pageSize": 100}
+        if modified_since is not None:
+            params["filterByFormula"] = self._modified_since_formula(modified_since)
+
+        records = []
+        offset = None
+        while True:
+            page_params = {**params, "offset": offset} if offset else params
+            response = await self._request("GET", self.base_url, priority=PRIORITY_BACKGROUND, params=page_params)
+            data = response.json()
+            records.extend(data.get("records", []))
+            offset = data.get("offset")
+            if not offset:
+                break
+        return records
@@ -0,0 +1,220 @@
+# bot/attachments.py
+import asyncio
+import logging
+import mimetypes
+import os
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Set
+from aiogram import Bot
+from aiogram.types import Message
+from .airtable_client import AirtableClient, MAX_UPLOAD_SIZE
+from .config import ATTACHMENT_MAX_UPLOADS, ATTACHMENT_MAX_INFLIGHT_BYTES, MEDIA_GROUP_WAIT
+
+ATTACHMENT_FIELD = "Вложение"
+CHUNK_SIZE = 64 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+def attachment_from_message(message: Message) -> Optional[Dict[str, Any]]:
+    """Описание файла из сообщения: file_id, file_unique_id, размер, имя и MIME-тип."""
+    if message.photo:
+        photo = message.photo[-1]
+        return {
+            "file_id": photo.file_id,
+            "file_unique_id": photo.file_unique_id,
+            "file_size": photo.file_size,
+            "file_name": f"{photo.file_unique_id}.jpg",
+            "mime_type": "image/jpeg"
+        }
+    media = message.document or message.video or message.audio
+    if media is None:
+        return None
+    return {
+        "file_id": media.file_id,
+        "file_unique_id": media.file_unique_id,
+        "file_size": media.file_size,
+        "file_name": media.file_name or media.file_unique_id,
+        "mime_type": media.mime_type
+    }
+
+
+def _display_name(attachment: Dict[str, Any]) -> str:
+    return attachment.get("file_name") or os.path.basename(attachment.get("file_path") or "") or attachment["file_id"]
+
+
+# on_album(messages) — вызывается один раз на альбом со всеми его сообщениями
+AlbumCallback = Callable[[List[Message]], Awaitable[None]]
+
+
+class MediaGroupCollector:
+    """Собирает сообщения одного альбома (общий media_group_id).
+
+    Telegram присылает каждый файл альбома отдельным сообщением, почти
+    одновременно. Сообщения копятся, пока в течение delay секунд приходят
+    новые из того же альбома, а затем передаются в callback одним списком
+    (в порядке message_id). Хендлер при этом сразу возвращается.
+    """
+
+    def __init__(self, delay: float = MEDIA_GROUP_WAIT):
+        self.delay = delay
+        self._groups: Dict[str, List[Message]] = {}
+        self._timers: Dict[str, asyncio.Task] = {}
+
+    def add(self, message: Message, callback: AlbumCallback):
+        group_id = message.media_group_id
+        self._groups.setdefault(group_id, []).append(message)
+        timer = self._timers.get(group_id)
+        if timer is not None:
+            timer.cancel()
+        self._timers[group_id] = asyncio.create_task(self._flush_later(group_id, callback))
+
+    async def _flush_later(self, group_id: str, callback: AlbumCallback):
+        await asyncio.sleep(self.delay)
+        messages = sorted(self._groups.pop(group_id), key=lambda m: m.message_id)
+        del self._timers[group_id]
+        try:
+            await callback(messages)
+        except Exception as e:
+            logger.error(f"Не удалось обработать альбом {group_id}: {e}", exc_info=True)
+
+
+class _ByteBudget:
+    """Семафор по объёму: одновременно загружается не больше limit байт
+    и не больше max_uploads файлов (один файл больше лимита допускается в одиночку)."""
+
+    def __init__(self, limit: int, max_uploads: int):
+        self.limit = limit
+        self.max_uploads = max_uploads
+        self._in_flight = 0
+        self._uploads = 0
+        self._cond = asyncio.Condition()
+
+    async def acquire(self, size: int):
+        async with self._cond:
+            await self._cond.wait_for(
+                lambda: self._uploads == 0
+                or (self._uploads < self.max_uploads and self._in_flight + size <= self.limit)
+            )
+            self._in_flight += size
+            self._uploads += 1
+
+    async def release(self, size: int):
+        async with self._cond:
+            self._in_flight -= size
+            self._uploads -= 1
+            self._cond.notify_all()
+
+
+# on_done(entry_id, error) — вызывается, когда все вложения записи обработаны
+DoneCallback = Callable[[int, Optional[str]], Awaitable[None]]
+# on_uploaded(entry_id, index) — файл attachments[index] записи загружен в Airtable
+UploadedCallback = Callable[[int, int], Awaitable[None]]
+
+
+class AttachmentUploader:
+    """Фоновая передача вложений из Telegram в уже созданные записи Airtable.
+
+    Файл скачивается из Telegram потоком и тем же потоком уходит в
+    uploadAttachment, не попадая в память целиком. Файлы больше
+    MAX_UPLOAD_SIZE (или неизвестного размера) Airtable так не принимает —
+    они не загружаются, и пользователь получает сообщение об ошибке.
+    Ссылка на файл в Telegram в Airtable не передаётся: в ней токен бота.
+    """
+
+    def __init__(self, client: AirtableClient):
+        self.client = client
+        self.bot: Optional[Bot] = None
+        self._budget = _ByteBudget(ATTACHMENT_MAX_INFLIGHT_BYTES, ATTACHMENT_MAX_UPLOADS)
+        self._tasks: Set[asyncio.Task] = set()
+        self._on_done: Optional[DoneCallback] = None
+        self._on_uploaded: Optional[UploadedCallback] = None
+
+    def start(self, bot: Bot, on_done: Optional[DoneCallback] = None,
+              on_uploaded: Optional[UploadedCallback] = None):
+        self.bot = bot
+        self._on_done = on_done
+        self._on_uploaded = on_uploaded
+
+    def submit(self, entry_id: int, record_id: str, attachments: List[Dict[str, Any]]):
+        task = asyncio.create_task(self._upload_record(entry_id, record_id, attachments))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def stop(self):
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _upload_record(self, entry_id: int, record_id: str, attachments: List[Dict[str, Any]]):
+        error = None
+        try:
+            # uploadAttachment дописывает файл в поле — уже загруженные до перезапуска
+            # (отмечены uploaded) повторно не отправляются
+            pending = [(i, a) for i, a in enumerate(attachments) if not a.get("uploaded")]
+            # Каждый файл — отдельно: ошибка getFile одного файла альбома (например,
+            # больше 20 МБ) не должна мешать загрузке остальных
+            files = await asyncio.gather(
+                *(self.bot.get_file(a["file_id"]) for _, a in pending), return_exceptions=True
+            )
+            errors: List[str] = []
+            large, small = [], []
+            for (i, attachment), file in zip(pending, files):
+                if isinstance(file, BaseException):
+                    if isinstance(file, asyncio.CancelledError):
+                        raise file
+                    errors.append(f"{_display_name(attachment)}: {file}")
+                    continue
+                attachment = {**attachment, "file_path": file.file_path, "file_size": file.file_size}
+                too_large = file.file_size is None or file.file_size > MAX_UPLOAD_SIZE
+                (large if too_large else small).append((i, attachment))
+            results = await asyncio.gather(
+                *(self._upload_file(entry_id, i, record_id, a) for i, a in small), return_exceptions=True
+            )
+            errors += [
+                f"{_display_name(a)}: {r}" for (_, a), r in zip(small, results) if isinstance(r, Exception)
+            ]
+            if large:
+                names = ", ".join(_display_name(a) for _, a in large)
+                errors.append(
+                    f"файлы больше {MAX_UPLOAD_SIZE // (1024 * 1024)} МБ не загружаются автоматически, "
+                    f"добавьте их в Airtable вручную: {names}"
+                )
+            if errors:
+                error = "; ".join(errors)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            error = str(e)
+        if error:
+            logger.error(f"Не удалось передать вложения записи {record_id}: {error}")
+        else:
+            logger.info(f"Вложения записи {record_id} загружены: {len(pending)} шт.")
+        if self._on_done is not None:
+            await self._on_done(entry_id, error)
+
+    async def _upload_file(self, entry_id: int, index: int, record_id: str, attachment: Dict[str, Any]):
+        size = attachment["file_size"]
+        url = self.bot.session.api.file_url(self.bot.token, attachment["file_path"])
+        content_type = (
+            attachment.get("mime_type")
+            or mimetypes.guess_type(attachment["file_path"])[0]
+            or "application/octet-stream"
+        )
+        file_name = attachment.get("file_name") or os.path.basename(attachment["file_path"])
+
+        def open_stream() -> AsyncIterator[bytes]:
+            return self.bot.session.stream_content(url, chunk_size=CHUNK_SIZE)
+
+        await self._budget.acquire(size)
+        try:
+            await self.client.upload_attachment(
+                record_id, ATTACHMENT_FIELD, file_name, content_type, size, open_stream
+            )
+        finally:
+            await self._budget.release(size)
+        if self._on_uploaded is not None:
+            try:
+                await self._on_uploaded(entry_id, index)
+            except Exception as e:
+                # Файл уже в Airtable; в худшем случае после перезапуска он загрузится ещё раз
+                logger.warning(f"Не удалось отметить загрузку файла записи {record_id}: {e}")
@@ -1,50 +1,285 @@
 # bot/cache_manager.py
-import os
+import asyncio
 import json
+import logging
 import time
 from pathlib import Path
-from typing import List
-from .airtable_client import AirtableClient
+from typing import Dict, List, Optional, Tuple
+from .airtable_client import AirtableClient, is_active_order
+from .metrics import ORDERS_CACHE_EVENTS
+from .config import (
+    ORDERS_CACHE_MAX_AGE, ORDERS_REFRESH_INTERVAL, ORDERS_FULL_SYNC_INTERVAL, SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL
+)
+from .order_index import OrderIndex, MappedOrderIndex, write_index_file
+from .search_cache import LRUCache, normalize_query
+from .sync import BackgroundSync, delta_since
 
 CACHE_DIR = Path(__file__).parent.parent / "cache"
-CACHE_FILE = CACHE_DIR / "orders_cache.json"
-CACHE_MAX_AGE = 24 * 3600  # 24 часа
+# Снимок заказов: ID записей, названия, нормализованные названия и готовый
+# поисковый индекс. Открывается через mmap без разбора; его же читают
+# остальные процессы webhook-сервера
+SNAPSHOT_FILE = CACHE_DIR / "orders_snapshot.bin"
+# JSON-кэш прежних версий — читается один раз, если снимка ещё нет
+LEGACY_CACHE_FILE = CACHE_DIR / "orders_cache.json"
+# Как часто процесс-читатель проверяет, не опубликована ли новая версия снимка
+SHARED_INDEX_CHECK_INTERVAL = 1.0
+CACHE_MAX_AGE = ORDERS_CACHE_MAX_AGE
+
+logger = logging.getLogger(__name__)
+
 
 class OrdersCache:
-    def __init__(self):
-        self.client = AirtableClient()
+    """Кэш заказов в памяти: устаревшие данные отдаются сразу, а обновление
+    идёт одной фоновой задачей на всех пользователей."""
+
+    def __init__(self, client: Optional[AirtableClient] = None):
+        self.client = client or AirtableClient()
+        self._loaded = False
+        # ID записи → название; после загрузки снимка собирается только при первой дельте
+        self._records: Optional[Dict[str, str]] = {}
+        self._updated_at = 0.0
+        self._full_synced_at = 0.0
+        self._index = OrderIndex([])
+        self.version = 0
+        # (версия, запрос, лимит) → [(ID записи, название)]; при новой версии очищается
+        self._results: LRUCache[List[Tuple[str, str]]] = LRUCache("results", SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)
+        self._follow_path: Optional[Path] = None
+        self._follow_stat = None
+        self._follow_checked_at = 0.0
+        self._refresher = BackgroundSync(self._fetch_and_cache)
 
     def _is_cache_fresh(self) -> bool:
-        if not CACHE_FILE.exists():
-            return False
-        file_age = time.time() - CACHE_FILE.stat().st_mtime
-        return file_age < CACHE_MAX_AGE
+        return self._loaded and time.time() - self._updated_at < CACHE_MAX_AGE
+
+    def _current_records(self) -> Dict[str, str]:
+        if self._records is None:
+            self._records = self._index.records()
+        return self._records
 
-    def _load_from_cache(self) -> List[str]:
+    def _read_legacy_cache_file(self) -> Optional[dict]:
         try:
-            with open(CACHE_FILE, "r", encoding="utf-8") as f:
+            with open(LEGACY_CACHE_FILE, "r", encoding="utf-8") as f:
                 data = json.load(f)
-                return data.get("orders", [])
-        except (FileNotFoundError, json.JSONDecodeError, KeyError):
-            return []
+            records = data.get("records")
+            full_synced_at = float(data.get("full_synced_at") or 0)
+            if records is None:
+                # Старый формат без ID записей — при следующем обновлении нужна полная выгрузка
+                records = {f"legacy{i}": name for i, name in enumerate(data.get("orders", []))}
+                full_synced_at = 0.0
+            return {
+                "records": records,
+                "updated_at": float(data.get("updated_at") or LEGACY_CACHE_FILE.stat().st_mtime),
+                "full_synced_at": full_synced_at
+            }
+        except (FileNotFoundError, json.JSONDecodeError, KeyError, TypeError, ValueError):
+            return None
+
+    def _open_snapshot(self, path: Path) -> Optional[MappedOrderIndex]:
+        try:
+            return MappedOrderIndex(path)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Не удалось открыть снимок заказов {path}: {e}")
+            return None
+
+    def _replace_index(self, index: OrderIndex):
+        previous, self._index = self._index, index
+        if isinstance(previous, MappedOrderIndex) and previous is not index:
+            # Поиск синхронный и не держит индекс между await — старый можно закрыть сразу
+            previous.close()
+
+    async def _save_snapshot(self):
+        index = self._index
+        if isinstance(index, MappedOrderIndex):
+            # Данные не менялись, но обновилось время синхронизации — перезаписываем снимок.
+            # Отображённый в память файл на Windows не заменить: сначала переходим на индекс в памяти
+            rebuilt = await asyncio.to_thread(OrderIndex, index.names, index.record_ids)
+            if self._index is index:
+                self._replace_index(rebuilt)
+            index = self._index
+        try:
+            await asyncio.to_thread(
+                write_index_file, index, SNAPSHOT_FILE, self.version, self._updated_at, self._full_synced_at
+            )
+        except OSError as e:
+            logger.warning(f"Не удалось сохранить снимок заказов на диск: {e}")
+
+    def _set_records(self, records: Dict[str, str], updated_at: float, full_synced_at: float,
+                     index: Optional[OrderIndex] = None):
+        if index is not None or not self._loaded or records != self._current_records():
+            self._replace_index(index or OrderIndex(list(records.values()), list(records.keys())))
+            self.version += 1
+            self._results.clear()
+        self._records = records
+        self._loaded = True
+        self._updated_at = updated_at
+        self._full_synced_at = full_synced_at
+
+    def _set_snapshot(self, index: MappedOrderIndex):
+        self._replace_index(index)
+        self._results.clear()
+        self._records = None
+        self._loaded = True
+        self.version = index.version
+        self._updated_at = index.updated_at
+        self._full_synced_at = index.full_synced_at
+
+    async def _load_from_cache(self) -> bool:
+        index = await asyncio.to_thread(self._open_snapshot, SNAPSHOT_FILE)
+        if index is not None:
+            self._set_snapshot(index)
+            logger.info(f"Загружен снимок заказов v{index.version}: {len(index)} шт.")
+            return True
+        data = await asyncio.to_thread(self._read_legacy_cache_file)
+        if data is None:
+            return False
+        self._set_records(data["records"], data["updated_at"], data["full_synced_at"])
+        await self._save_snapshot()
+        logger.info(f"Кэш заказов {LEGACY_CACHE_FILE.name} перенесён в снимок: {len(self._index)} шт.")
+        return True
+
+    def follow(self, path: Path = SNAPSHOT_FILE):
+        """Режим читателя: индекс берётся из снимка, который обновляет основной процесс."""
+        self._follow_path = path
+
+    def _check_shared_index(self):
+        now = time.monotonic()
+        if now - self._follow_checked_at < SHARED_INDEX_CHECK_INTERVAL:
+            return
+        self._follow_checked_at = now
+        try:
+            st = self._follow_path.stat()
+        except FileNotFoundError:
+            return
+        stat_key = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if stat_key == self._follow_stat:
+            return
+        index = self._open_snapshot(self._follow_path)
+        if index is None:
+            return
+        # Файл подменяется целиком (os.replace), так что новая версия видна атомарно
+        self._set_snapshot(index)
+        self._follow_stat = stat_key
+        logger.info(f"Загружен общий индекс заказов v{index.version}: {len(index)} шт.")
+
+    def _needs_full_sync(self, now: float) -> bool:
+        return not self._loaded or now - self._full_synced_at >= ORDERS_FULL_SYNC_INTERVAL
 
-    async def _fetch_and_cache(self) -> List[str]:
+    async def _fetch_and_cache(self):
+        started_at = time.time()
+        full = self._needs_full_sync(started_at)
         try:
-            orders = await self.client.get_order_names()
-            CACHE_DIR.mkdir(exist_ok=True)
-            with open(CACHE_FILE, "w", encoding="utf-8") as f:
-                json.dump({
-                    "updated_at": time.time(),
-                    "orders": orders
-                }, f, ensure_ascii=False, indent=2)
-            return orders
+            if full:
+                fetched = await self.client.get_order_records()
+            else:
+                fetched = await self.client.get_order_records(modified_since=delta_since(self._updated_at))
         except Exception as e:
-            if CACHE_FILE.exists():
-                return self._load_from_cache()
-            return []
+            ORDERS_CACHE_EVENTS.inc("refresh_error")
+            logger.error(f"Не удалось обновить список заказов: {e}")
+            return
+        ORDERS_CACHE_EVENTS.inc("refresh_full" if full else "refresh_delta")
+
+        if full:
+            records = {r["id"]: r["name"] for r in fetched if is_active_order(r)}
+            full_synced_at = started_at
+        else:
+            # Дельта: добавляем новые, переименовываем и убираем ставшие неактивными
+            records = dict(self._current_records())
+            for r in fetched:
+                if is_active_order(r):
+                    records[r["id"]] = r["name"]
+                else:
+                    records.pop(r["id"], None)
+            full_synced_at = self._full_synced_at
+
+        changed = not self._loaded or records != self._current_records()
+        index = None
+        if changed:
+            # Индекс строится в отдельном потоке, чтобы не задерживать хендлеры
+            index = await asyncio.to_thread(OrderIndex, list(records.values()), list(records.keys()))
+        self._set_records(records, started_at, full_synced_at, index)
+        if full or changed:
+            await self._save_snapshot()
+        if full:
+            logger.info(f"Список заказов выгружен полностью: {len(records)} шт.")
+        elif changed:
+            logger.info(f"Список заказов обновлён: изменено {len(fetched)}, всего {len(records)} шт.")
+
+    def _schedule_refresh(self) -> asyncio.Task:
+        return self._refresher.schedule()
+
+    async def refresh(self):
+        await self._refresher.run()
+
+    async def warm(self):
+        """Загружает заказы при старте: с диска, а если кэша нет — из Airtable."""
+        if not await self._load_from_cache():
+            await self.refresh()
+        elif not self._is_cache_fresh():
+            self._schedule_refresh()
+
+    def start_refresher(self, interval: int = ORDERS_REFRESH_INTERVAL):
+        self._refresher.start(interval)
+
+    async def stop(self):
+        await self._refresher.stop()
+
+    @property
+    def size(self) -> int:
+        """Заказов в текущем индексе."""
+        return len(self._index)
+
+    @property
+    def results_cache_size(self) -> int:
+        """Размер кэша результатов поиска (в запросах)."""
+        return self._results.size
+
+    @property
+    def token_cache_size(self) -> int:
+        """Размер кэша совпадений слов текущего индекса (в заказах)."""
+        return self._index.token_cache_size
+
+    async def _ensure_loaded(self):
+        if not self._loaded:
+            # Кэш не прогрет (например, при запуске вне бота)
+            ORDERS_CACHE_EVENTS.inc("miss")
+            await self.warm()
+        elif not self._is_cache_fresh():
+            ORDERS_CACHE_EVENTS.inc("stale")
+            self._schedule_refresh()
+        else:
+            ORDERS_CACHE_EVENTS.inc("hit")
 
     async def get_orders(self) -> List[str]:
-        if self._is_cache_fresh():
-            return self._load_from_cache()
+        await self._ensure_loaded()
+        return self._index.names
+
+    def order_name(self, record_id: str) -> Optional[str]:
+        """Текущее название заказа по ID записи (None, если заказа уже нет в кэше)."""
+        return self._current_records().get(record_id)
+
+    async def get_index(self) -> OrderIndex:
+        if self._follow_path is not None:
+            ORDERS_CACHE_EVENTS.inc("shared")
+            self._check_shared_index()
         else:
-            return await self._fetch_and_cache()
+            await self._ensure_loaded()
+        return self._index
+
+    async def search(self, query: str, limit: int, budget: Optional[float] = None) -> List[Tuple[str, str]]:
+        """Лучшие заказы по запросу: [(ID записи, название)], как OrderIndex.top().
+
+        Результат запоминается по нормализованному запросу и версии кэша, так что
+        повторный поиск того же заказа не сканирует индекс. Неполный результат
+        (кончился budget) не запоминается.
+        """
+        index = await self.get_index()
+        key = (self.version, normalize_query(query), limit)
+        found = self._results.get(key)
+        if found is None:
+            positions, complete = index.rank(query, limit, budget)
+            found = [(index.record_id(i), index.name(i)) for i in positions]
+            if complete:
+                self._results.put(key, found)
+        return found
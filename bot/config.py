@@ -26,3 +26,100 @@ AIRTABLE_ORDERS_TABLE_ID = os.getenv("AIRTABLE_ORDERS_TABLE_ID")
 # Проверяем, что всё указано
 if not all([AIRTABLE_API_KEY, AIRTABLE_BASE_ID, AIRTABLE_TABLE_ID, AIRTABLE_ORDERS_TABLE_ID]):
     raise ValueError("Один или несколько Airtable параметров не указаны в .env")
+
+# Настройки HTTP-клиента Airtable (общий пул соединений на процесс)
+AIRTABLE_HTTP2 = os.getenv("AIRTABLE_HTTP2", "false").strip().lower() in {"1", "true", "yes"}
+AIRTABLE_TIMEOUT = float(os.getenv("AIRTABLE_TIMEOUT", 20))
+AIRTABLE_CONNECT_TIMEOUT = float(os.getenv("AIRTABLE_CONNECT_TIMEOUT", 10))
+AIRTABLE_MAX_CONNECTIONS = int(os.getenv("AIRTABLE_MAX_CONNECTIONS", 10))
+AIRTABLE_MAX_KEEPALIVE = int(os.getenv("AIRTABLE_MAX_KEEPALIVE", 5))
+AIRTABLE_KEEPALIVE_EXPIRY = float(os.getenv("AIRTABLE_KEEPALIVE_EXPIRY", 30))
+
+# Общий лимит запросов к базе Airtable (у Airtable — 5 запросов в секунду на базу)
+# и число попыток при сетевых ошибках, 429 и 5xx
+AIRTABLE_RATE_LIMIT = float(os.getenv("AIRTABLE_RATE_LIMIT", 4))
+AIRTABLE_RATE_BURST = int(os.getenv("AIRTABLE_RATE_BURST", 4))
+AIRTABLE_MAX_ATTEMPTS = int(os.getenv("AIRTABLE_MAX_ATTEMPTS", 5))
+
+# Кэш заказов: через сколько секунд данные считаются устаревшими,
+# как часто подтягивать изменения в фоне (0 — без периодического обновления)
+# и как часто делать полную выгрузку (чтобы убрать удалённые записи)
+ORDERS_CACHE_MAX_AGE = int(os.getenv("ORDERS_CACHE_MAX_AGE", 24 * 3600))
+ORDERS_REFRESH_INTERVAL = int(os.getenv("ORDERS_REFRESH_INTERVAL", 60))
+ORDERS_FULL_SYNC_INTERVAL = int(os.getenv("ORDERS_FULL_SYNC_INTERVAL", 24 * 3600))
+
+# Очередь оплат: сколько секунд копить записи перед отправкой пачкой
+# и сколько запросов в секунду допускается при выгрузке очереди в Airtable
+OUTBOX_BATCH_DELAY = float(os.getenv("OUTBOX_BATCH_DELAY", 0.5))
+OUTBOX_MAX_RPS = float(os.getenv("OUTBOX_MAX_RPS", 4))
+
+# Локальная реплика таблицы оплат для /recent, /summary, /daily: как часто догонять
+# правки из Airtable и как часто выгружать таблицу целиком (чтобы убрать удалённые),
+# сколько оплат показывает /recent
+PAYMENTS_SYNC_INTERVAL = int(os.getenv("PAYMENTS_SYNC_INTERVAL", 300))
+PAYMENTS_FULL_SYNC_INTERVAL = int(os.getenv("PAYMENTS_FULL_SYNC_INTERVAL", 24 * 3600))
+RECENT_PAYMENTS_LIMIT = int(os.getenv("RECENT_PAYMENTS_LIMIT", 10))
+
+# Защита от повторов: сколько update_id помнить и сколько секунд (повторная доставка
+# Telegram), и сколько секунд повторное сохранение того же диалога оплаты
+# возвращает уже сохранённую запись, а не создаёт новую
+UPDATE_DEDUP_SIZE = int(os.getenv("UPDATE_DEDUP_SIZE", 10000))
+UPDATE_DEDUP_TTL = float(os.getenv("UPDATE_DEDUP_TTL", 3600))
+PAYMENT_DEDUP_WINDOW = float(os.getenv("PAYMENT_DEDUP_WINDOW", 600))
+
+# Хранилище диалогов (FSM): "sqlite" — переживает перезапуск и общее для процессов,
+# "memory" — в памяти процесса. FSM_TTL — сколько секунд хранить брошенный диалог
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite").strip().lower()
+FSM_TTL = int(os.getenv("FSM_TTL", 24 * 3600))
+
+# Число процессов webhook-сервера (1 — один процесс). Несколько процессов
+# слушают один порт через SO_REUSEPORT (Linux/BSD) и требуют FSM_STORAGE=sqlite
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", 1))
+
+# Очередь обновлений в режиме webhook: число обработчиков, общий размер очереди
+# и сколько секунд ждать места в ней, прежде чем ответить Telegram 503
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", 8))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", 1000))
+UPDATE_QUEUE_PUT_TIMEOUT = float(os.getenv("UPDATE_QUEUE_PUT_TIMEOUT", 5))
+
+# Загрузка вложений в Airtable: сколько файлов и сколько байт одновременно
+ATTACHMENT_MAX_UPLOADS = int(os.getenv("ATTACHMENT_MAX_UPLOADS", 4))
+ATTACHMENT_MAX_INFLIGHT_BYTES = int(os.getenv("ATTACHMENT_MAX_INFLIGHT_BYTES", 16 * 1024 * 1024))
+# Альбом (несколько фото одним сообщением) приходит отдельными сообщениями —
+# сколько секунд ждать следующее, прежде чем начать одну оплату на весь альбом
+MEDIA_GROUP_WAIT = float(os.getenv("MEDIA_GROUP_WAIT", 0.8))
+
+# Импорт оплат из выписки (CSV/XLSX): кому разрешено присылать файлы боту
+# (ID через запятую), сколько пачек по 10 записей отправлять одновременно
+# и сколько таких запросов в секунду допускать (остальное — пользователям бота)
+IMPORT_ADMINS = set(
+    int(uid.strip()) for uid in os.getenv("IMPORT_ADMINS", "").split(",") if uid.strip()
+)
+IMPORT_CONCURRENCY = int(os.getenv("IMPORT_CONCURRENCY", 2))
+IMPORT_MAX_RPS = float(os.getenv("IMPORT_MAX_RPS", 2))
+
+# Кэши поиска заказов: сколько запросов хранить готовыми и сколько секунд,
+# и сколько номеров заказов держать в списках совпадений отдельных слов
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", 1024))
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", 300))
+SEARCH_TOKEN_CACHE_SIZE = int(os.getenv("SEARCH_TOKEN_CACHE_SIZE", 1_000_000))
+
+# Журнал: формат файла logs/*.log ("text" или "json" — JSON lines) и размер
+# очереди записей; при переполнении записи отбрасываются со сводкой в журнале
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").strip().lower()
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10000))
+
+# Метрики Prometheus: отдельный сервер на METRICS_HOST:METRICS_PORT (0 — не запускать),
+# на публичном порту webhook их нет. При WEB_WORKERS > 1 каждый процесс
+# слушает METRICS_PORT + номер процесса
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").strip().lower() in {"1", "true", "yes"}
+METRICS_PATH = os.getenv("METRICS_PATH", "/metrics")
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9100))
+
+# Inline-поиск заказов (@бот запрос): пауза перед поиском (новый запрос того же
+# пользователя отменяет предыдущий), сколько секунд Telegram кэширует ответ
+# и бюджет времени на поиск, после которого отдаются найденные к этому моменту
+INLINE_DEBOUNCE = float(os.getenv("INLINE_DEBOUNCE", 0.15))
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", 30))
+INLINE_LATENCY_BUDGET = float(os.getenv("INLINE_LATENCY_BUDGET", 0.015))
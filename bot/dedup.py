@@ -0,0 +1,51 @@
+# bot/dedup.py
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable
+from aiogram import BaseMiddleware
+from .config import UPDATE_DEDUP_SIZE, UPDATE_DEDUP_TTL
+from .metrics import DUPLICATES_SUPPRESSED
+
+
+class ExpiringSet:
+    """Множество ключей, каждый из которых помнится ttl секунд; не больше max_size ключей."""
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        # Ключ → когда забыть; порядок добавления совпадает с порядком истечения
+        self._items: "OrderedDict[Hashable, float]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def add(self, key: Hashable) -> bool:
+        """Запоминает ключ; False — ключ уже был (и ещё не истёк)."""
+        now = time.monotonic()
+        while self._items:
+            oldest, expires_at = next(iter(self._items.items()))
+            if expires_at > now and len(self._items) < self.max_size:
+                break
+            del self._items[oldest]
+        if key in self._items:
+            return False
+        self._items[key] = now + self.ttl
+        return True
+
+
+class DuplicateUpdateMiddleware(BaseMiddleware):
+    """Outer middleware на update: пропускает обновления с уже обработанным update_id.
+
+    Telegram повторяет доставку, если webhook ответил не сразу, — повтор не
+    должен второй раз пройти диалог и создать запись. Множество живёт в памяти
+    процесса; от двойной записи между процессами защищает ключ оплаты в очереди.
+    """
+
+    def __init__(self, max_size: int = UPDATE_DEDUP_SIZE, ttl: float = UPDATE_DEDUP_TTL):
+        self.seen = ExpiringSet(max_size, ttl)
+
+    async def __call__(self, handler, event, data: Dict[str, Any]):
+        if not self.seen.add(event.update_id):
+            DUPLICATES_SUPPRESSED.inc("update")
+            return None
+        return await handler(event, data)
@@ -0,0 +1,158 @@
+# bot/fsm_storage.py
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, Mapping, Optional, Tuple
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+
+FSM_FILE = Path(__file__).parent.parent / "cache" / "fsm.sqlite3"
+# Как часто (в секундах) удалять из базы просроченные диалоги
+PURGE_INTERVAL = 600
+
+# update(state, data) → (новое состояние, новые данные, результат для вызывающего)
+Transaction = Callable[[Optional[str], Dict[str, Any]], Tuple[Optional[str], Dict[str, Any], Any]]
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище aiogram в локальном SQLite (WAL).
+
+    Диалоги переживают перезапуск службы и доступны всем процессам бота,
+    открывшим один и тот же файл. Брошенные диалоги истекают через ttl секунд
+    после последнего изменения.
+    """
+
+    def __init__(self, path: Path, ttl: Optional[int] = None, key_builder: Optional[KeyBuilder] = None):
+        self.path = path
+        self.ttl = ttl or None
+        self.key_builder = key_builder or DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._purged_at = 0.0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.path.parent.mkdir(exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS fsm (
+                    key TEXT PRIMARY KEY,
+                    state TEXT,
+                    data TEXT,
+                    expires_at REAL
+                ) WITHOUT ROWID
+            """)
+            self._conn = conn
+        return self._conn
+
+    def _expires_at(self, now: float) -> Optional[float]:
+        return now + self.ttl if self.ttl else None
+
+    def _read(self, conn: sqlite3.Connection, key: str, now: float):
+        row = conn.execute(
+            "SELECT state, data FROM fsm WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (key, now)
+        ).fetchone()
+        if row is None:
+            return None, {}
+        return row[0], json.loads(row[1]) if row[1] else {}
+
+    def _write(self, conn: sqlite3.Connection, key: str, state: Optional[str], data: Mapping[str, Any], now: float):
+        if state is None and not data:
+            conn.execute("DELETE FROM fsm WHERE key = ?", (key,))
+            return
+        conn.execute(
+            "INSERT INTO fsm (key, state, data, expires_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET state = excluded.state, data = excluded.data, "
+            "expires_at = excluded.expires_at",
+            (
+                key,
+                state,
+                json.dumps(data, ensure_ascii=False, separators=(",", ":")) if data else None,
+                self._expires_at(now)
+            )
+        )
+
+    def _purge(self, conn: sqlite3.Connection, now: float):
+        if self.ttl and now - self._purged_at >= PURGE_INTERVAL:
+            conn.execute("DELETE FROM fsm WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,))
+            self._purged_at = now
+
+    def _transact(self, key: str, update: Transaction) -> Any:
+        """Читает и записывает состояние и данные записи в одной транзакции (BEGIN IMMEDIATE)."""
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                state, data, result = update(*self._read(conn, key, now))
+                self._write(conn, key, state, data, now)
+                self._purge(conn, now)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return result
+
+    def _modify(self, key: str, state: Any = ..., data: Optional[Mapping[str, Any]] = None,
+                merge: bool = False) -> Dict[str, Any]:
+        """Атомарно меняет состояние и/или данные записи."""
+        def update(current_state: Optional[str], current_data: Dict[str, Any]):
+            if state is not ...:
+                current_state = state
+            if data is not None:
+                current_data = {**current_data, **data} if merge else dict(data)
+            return current_state, current_data, current_data
+        return self._transact(key, update)
+
+    def _get(self, key: str):
+        with self._lock:
+            return self._read(self._connect(), key, time.time())
+
+    def _count_active(self) -> int:
+        with self._lock:
+            return self._connect().execute(
+                "SELECT COUNT(*) FROM fsm WHERE state IS NOT NULL AND (expires_at IS NULL OR expires_at > ?)",
+                (time.time(),)
+            ).fetchone()[0]
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        value = state.state if isinstance(state, State) else state
+        await asyncio.to_thread(self._modify, self.key_builder.build(key), value)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state, _ = await asyncio.to_thread(self._get, self.key_builder.build(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        await asyncio.to_thread(self._modify, self.key_builder.build(key), ..., data)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, data = await asyncio.to_thread(self._get, self.key_builder.build(key))
+        return data
+
+    async def update_data(self, key: StorageKey, data: Mapping[str, Any]) -> Dict[str, Any]:
+        # В отличие от базовой реализации чтение и запись идут в одной транзакции,
+        # чтобы параллельные процессы не затирали изменения друг друга
+        return await asyncio.to_thread(self._modify, self.key_builder.build(key), ..., data, True)
+
+    async def transact(self, key: StorageKey, update: Transaction) -> Any:
+        """Атомарное чтение-изменение-запись диалога, в том числе между процессами бота."""
+        return await asyncio.to_thread(self._transact, self.key_builder.build(key), update)
+
+    async def count_active(self) -> int:
+        """Количество незавершённых диалогов (с установленным состоянием)."""
+        return await asyncio.to_thread(self._count_active)
+
+    async def close(self) -> None:
+        def close():
+            with self._lock:
+                if self._conn is not None:
+                    self._conn.close()
+                    self._conn = None
+        await asyncio.to_thread(close)
@@ -1,5 +1,14 @@
 # bot/handlers.py
+import asyncio
+import html
+import io
 import logging
+import math
+import time
+import uuid
+from datetime import date, datetime
+from functools import partial
+from typing import Any, Dict, List, Set
 from aiogram import Router, F, Bot
 from aiogram.types import (
     Message,
@@ -8,20 +17,44 @@ from aiogram.types import (
     ContentType,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
-    CallbackQuery
+    CallbackQuery,
+    InlineQuery,
+    BufferedInputFile
 )
 from aiogram.fsm.context import FSMContext
-from aiogram.filters import Command, CommandStart
-from rapidfuzz import process as fuzz_process, fuzz
+from aiogram.filters import Command, CommandObject, CommandStart
+from aiogram.dispatcher.event.bases import SkipHandler
 from .states import PaymentForm
-from .config import AUTHORIZED_USERS, TELEGRAM_BOT_TOKEN
+from .config import (
+    AUTHORIZED_USERS, IMPORT_ADMINS, INLINE_DEBOUNCE, INLINE_CACHE_TIME, INLINE_LATENCY_BUDGET, RECENT_PAYMENTS_LIMIT
+)
 from .airtable_client import AirtableClient
 from .cache_manager import OrdersCache
+from .fsm_storage import SQLiteStorage
+from .outbox import PaymentOutbox, payment_key
+from .attachments import AttachmentUploader, MediaGroupCollector, attachment_from_message
+from .inline_orders import InlineDebouncer, order_results, INLINE_RESULTS_LIMIT, INLINE_MIN_QUERY_LENGTH
+from .metrics import INLINE_EVENTS, INLINE_SECONDS
+from .payment_import import ImportFileError, PaymentImport
+from .payments_replica import PaymentsReplica
+
+# Сколько лучших совпадений предлагать и сколько кнопок показывать на странице
+ORDER_RESULTS_LIMIT = 50
+ORDER_PAGE_SIZE = 8
 
 router = Router()
 logger = logging.getLogger(__name__)
 airtable_client = AirtableClient()
-orders_cache = OrdersCache()
+orders_cache = OrdersCache(airtable_client)
+attachment_uploader = AttachmentUploader(airtable_client)
+outbox = PaymentOutbox(airtable_client, attachment_uploader)
+payments_replica = PaymentsReplica(airtable_client)
+# Созданные записи (очередь оплат, импорт) сразу попадают в реплику
+airtable_client.on_created = payments_replica.add_created
+inline_debouncer = InlineDebouncer(INLINE_DEBOUNCE)
+album_collector = MediaGroupCollector()
+# Импорты выписок идут в фоне; ссылки держим, чтобы задачи не собрал сборщик мусора
+import_tasks: Set[asyncio.Task] = set()
 
 # === КЛАВИАТУРЫ ===
 main_kb = ReplyKeyboardMarkup(
@@ -38,6 +71,25 @@ skip_cancel_kb = ReplyKeyboardMarkup(
     one_time_keyboard=True
 )
 
+def order_options_kb(options: List[Dict[str, Any]], page: int) -> InlineKeyboardMarkup:
+    """Страница вариантов заказа; последний вариант — введённый текст как есть."""
+    pages = max(1, math.ceil(len(options) / ORDER_PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+    start = page * ORDER_PAGE_SIZE
+    buttons = [
+        [InlineKeyboardButton(text=opt["name"], callback_data=f"order:{start + i}")]
+        for i, opt in enumerate(options[start:start + ORDER_PAGE_SIZE])
+    ]
+    if pages > 1:
+        nav = []
+        if page > 0:
+            nav.append(InlineKeyboardButton(text="◀️", callback_data=f"order_page:{page - 1}"))
+        nav.append(InlineKeyboardButton(text=f"{page + 1}/{pages}", callback_data="order_page:noop"))
+        if page < pages - 1:
+            nav.append(InlineKeyboardButton(text="▶️", callback_data=f"order_page:{page + 1}"))
+        buttons.append(nav)
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
 def is_authorized(user) -> bool:
     return user.id in AUTHORIZED_USERS
 
@@ -57,9 +109,116 @@ async def start_payment_by_button(message: Message, state: FSMContext):
     if not is_authorized(message.from_user):
         await message.answer("🚫 У вас нет доступа к этому действию")
         return
+    await state.update_data(dialog_id=_new_dialog_id())
     await message.answer("Добавьте вложение:", reply_markup=skip_cancel_kb)
     await state.set_state(PaymentForm.attachment)
 
+@router.message(Command("import"), F.document)
+async def import_payments(message: Message, bot: Bot):
+    if message.from_user.id not in IMPORT_ADMINS:
+        await message.answer("🚫 Импорт выписок доступен только администраторам")
+        return
+    document = message.document
+    await message.answer(f"⏳ Импорт {html.escape(document.file_name or '')} начат, пришлю отчёт по завершении")
+    # Хендлер сразу возвращается: импорт может идти минутами и не должен занимать обработчик обновлений
+    task = asyncio.create_task(_run_import(bot, message.chat.id, message.from_user, document))
+    import_tasks.add(task)
+    task.add_done_callback(import_tasks.discard)
+
+async def _run_import(bot: Bot, chat_id: int, user, document):
+    sender_name = user.first_name + (f" {user.last_name}" if user.last_name else "")
+    try:
+        buffer = io.BytesIO()
+        await bot.download(document, destination=buffer)
+        report = await PaymentImport(
+            airtable_client, orders_cache, buffer.getvalue(), document.file_name or "import.csv", sender_name
+        ).run()
+    except ImportFileError as e:
+        await bot.send_message(chat_id, f"❌ {e}")
+        return
+    except Exception as e:
+        logger.error(f"Ошибка импорта {document.file_name}: {e}", exc_info=True)
+        await bot.send_message(chat_id, "❌ Импорт прерван из-за ошибки. Пришлите файл ещё раз — "
+                                        "уже записанные строки повторно не запишутся")
+        return
+    await bot.send_message(chat_id, f"✅ Импорт {html.escape(document.file_name or '')} завершён\n{report.summary()}")
+    if report.flagged or report.failed:
+        await bot.send_document(
+            chat_id,
+            BufferedInputFile(report.flagged_csv(), filename=f"{document.file_name}.flagged.csv"),
+            caption="Строки, которые нужно проверить вручную"
+        )
+
+def _new_dialog_id() -> str:
+    """Метка нового диалога оплаты: по ней повтор сохранения отличается от новой оплаты."""
+    return uuid.uuid4().hex
+
+# === ПРОСМОТР ОПЛАТ (из локальной реплики, без запросов к Airtable) ===
+def _format_amount(amount) -> str:
+    return "—" if amount is None else f"{amount:,.2f}".replace(",", " ")
+
+def _format_time(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp).strftime("%d.%m.%Y %H:%M")
+
+@router.message(Command("recent"))
+async def cmd_recent(message: Message):
+    if not is_authorized(message.from_user):
+        await message.answer("🚫 У вас нет доступа к этому действию")
+        return
+    payments = await payments_replica.recent(RECENT_PAYMENTS_LIMIT)
+    if not payments:
+        await message.answer("Оплат пока нет")
+        return
+    lines = [f"🧾 Последние оплаты ({len(payments)}):"]
+    for payment in payments:
+        line = f"\n<b>{_format_time(payment.created_at)}</b> · {_format_amount(payment.amount)}"
+        if payment.order:
+            line += f"\n<b>Заказ:</b> {html.escape(payment.order)}"
+        line += f"\n<b>Отправитель:</b> {html.escape(payment.sender)}"
+        lines.append(line)
+    await message.answer("\n".join(lines))
+
+@router.message(Command("summary"))
+async def cmd_summary(message: Message, command: CommandObject):
+    if not is_authorized(message.from_user):
+        await message.answer("🚫 У вас нет доступа к этому действию")
+        return
+    if not command.args:
+        await message.answer("Укажите заказ: <code>/summary АОС-0125</code>")
+        return
+    summary = await payments_replica.order_summary(command.args)
+    if not summary.count:
+        await message.answer(f"По заказу {html.escape(command.args)} оплат нет")
+        return
+    await message.answer(
+        f"📊 <b>Заказ:</b> {html.escape(command.args)}\n"
+        f"<b>Оплат:</b> {summary.count}\n"
+        f"<b>Сумма:</b> {_format_amount(summary.total)}\n"
+        f"<b>Период:</b> {_format_time(summary.first_at)} — {_format_time(summary.last_at)}"
+    )
+
+@router.message(Command("daily"))
+async def cmd_daily(message: Message, command: CommandObject):
+    if not is_authorized(message.from_user):
+        await message.answer("🚫 У вас нет доступа к этому действию")
+        return
+    day = date.today()
+    if command.args:
+        try:
+            day = datetime.strptime(command.args.strip(), "%d.%m.%Y").date()
+        except ValueError:
+            await message.answer("Укажите дату в формате ДД.ММ.ГГГГ: <code>/daily 01.03.2024</code>")
+            return
+    totals = await payments_replica.daily_totals(day)
+    if not totals:
+        await message.answer(f"За {day:%d.%m.%Y} оплат нет")
+        return
+    lines = [f"📅 Оплаты за {day:%d.%m.%Y} по отправителям:"]
+    for sender, count, total in totals:
+        lines.append(f"{html.escape(sender or '—')}: {_format_amount(total)} ({count})")
+    lines.append(f"<b>Итого:</b> {_format_amount(sum(t[2] for t in totals))} ({sum(t[1] for t in totals)})")
+    await message.answer("\n".join(lines))
+
 @router.message(F.content_type.in_({
     ContentType.PHOTO,
     ContentType.DOCUMENT,
@@ -70,19 +229,40 @@ async def start_payment_by_attachment(message: Message, state: FSMContext, bot:
     if not is_authorized(message.from_user):
         await message.answer("🚫 У вас нет доступа к этому действию")
         return
-    file_id = None
-    if message.photo:
-        file_id = message.photo[-1].file_id
-    elif message.document:
-        file_id = message.document.file_id
-    elif message.video:
-        file_id = message.video.file_id
-    elif message.audio:
-        file_id = message.audio.file_id
-    await state.update_data(attachment=file_id)
+    if message.media_group_id:
+        # Альбом: каждый файл приходит отдельным сообщением — оплата начнётся одна на все
+        album_collector.add(message, partial(start_payment_by_album, state))
+        return
+    await state.update_data(
+        attachments=[attachment_from_message(message)], media_group_id=None, dialog_id=_new_dialog_id()
+    )
     await message.answer("Введите сумму:", reply_markup=skip_cancel_kb)
     await state.set_state(PaymentForm.amount)
 
+def _merge_album(media_group_id: str, attachments: List[Dict[str, Any]], current_state, data: Dict[str, Any]):
+    """Дописывает часть альбома к начатой оплате или начинает новую; третий элемент — начата ли оплата."""
+    if data.get("media_group_id") == media_group_id:
+        # Часть альбома пришла позже (или в другой процесс webhook) — дописываем к начатой оплате
+        return current_state, {**data, "attachments": (data.get("attachments") or []) + attachments}, False
+    data = {**data, "attachments": attachments, "media_group_id": media_group_id, "dialog_id": _new_dialog_id()}
+    return PaymentForm.amount.state, data, True
+
+async def start_payment_by_album(state: FSMContext, messages: List[Message]):
+    first = messages[0]
+    attachments = [attachment_from_message(m) for m in messages]
+    merge = partial(_merge_album, first.media_group_id, attachments)
+    if isinstance(state.storage, SQLiteStorage):
+        # Части альбома в разных процессах webhook не затирают друг друга
+        # и не отправляют запрос суммы дважды
+        started = await state.storage.transact(state.key, merge)
+    else:
+        # MemoryStorage — один процесс, и его методы не уступают управление
+        new_state, data, started = merge(await state.get_state(), await state.get_data())
+        await state.set_data(data)
+        await state.set_state(new_state)
+    if started:
+        await first.answer(f"📎 Вложений: {len(attachments)}\nВведите сумму:", reply_markup=skip_cancel_kb)
+
 @router.message(F.text == "Отмена")
 async def handle_cancel(message: Message, state: FSMContext):
     current_state = await state.get_state()
@@ -94,7 +274,7 @@ async def handle_cancel(message: Message, state: FSMContext):
 
 @router.message(PaymentForm.attachment, F.text == "Пропустить")
 async def skip_attachment(message: Message, state: FSMContext):
-    await state.update_data(attachment=None)
+    await state.update_data(attachments=[], media_group_id=None)
     await message.answer("Введите сумму:", reply_markup=skip_cancel_kb)
     await state.set_state(PaymentForm.amount)
 
@@ -135,6 +315,37 @@ async def process_note(message: Message, state: FSMContext):
     await message.answer("Введите номер заказа:", reply_markup=skip_cancel_kb)
     await state.set_state(PaymentForm.order)
 
+# === INLINE-ПОИСК ЗАКАЗА ===
+@router.inline_query()
+async def inline_order_search(inline_query: InlineQuery):
+    query = inline_query.query.strip()
+    if not is_authorized(inline_query.from_user) or len(query) < INLINE_MIN_QUERY_LENGTH:
+        await inline_query.answer([], cache_time=INLINE_CACHE_TIME, is_personal=True)
+        return
+
+    async def answer():
+        started = time.perf_counter()
+        found = await orders_cache.search(query, INLINE_RESULTS_LIMIT, budget=INLINE_LATENCY_BUDGET)
+        results = order_results(found)
+        elapsed = time.perf_counter() - started
+        INLINE_SECONDS.observe(elapsed)
+        if elapsed > INLINE_LATENCY_BUDGET:
+            INLINE_EVENTS.inc("over_budget")
+        await inline_query.answer(results, cache_time=INLINE_CACHE_TIME, is_personal=True)
+        INLINE_EVENTS.inc("answered")
+
+    inline_debouncer.schedule(inline_query.from_user.id, answer)
+
+@router.message(PaymentForm.order, F.via_bot)
+@router.message(PaymentForm.order_selection, F.via_bot)
+async def process_inline_order(message: Message, state: FSMContext):
+    if message.via_bot.id != message.bot.id or not message.text:
+        # Сообщение через другого бота — обычный ввод заказа
+        raise SkipHandler()
+    # Заказ выбран в inline-поиске — в сообщении точное название
+    await state.update_data(order=message.text)
+    await _save_data_and_finish(message.bot, message.from_user, state)
+
 # === ОБНОВЛЁННЫЙ ХЕНДЛЕР ЗАКАЗА ===
 @router.message(PaymentForm.order, F.text)
 async def process_order(message: Message, state: FSMContext):
@@ -155,43 +366,21 @@ async def process_order(message: Message, state: FSMContext):
         return
 
     try:
-        orders_original = await orders_cache.get_orders()
-        if not orders_original:
+        if not len(await orders_cache.get_index()):
             await state.update_data(order=user_input_raw)
             await _save_data_and_finish(message.bot, message.from_user, state)
             return
 
-        orders_lower = [name.lower() for name in orders_original]
-        results = []
-        
-        for token in user_input_norm.split():
-            matches = fuzz_process.extract(
-                token,
-                orders_lower,
-                scorer=fuzz.partial_ratio,
-                score_cutoff=80,
-                limit=None
-            )           
-
-            matched_indices = {match[2] for match in matches}
-            results.append(matched_indices)
-        
-        if not results:
-            indices = set()
-        else:
-            indices = results[0].intersection(*results[1:]) if len(results) > 1 else results[0]
-
-        found_orders = [orders_original[i] for i in indices]
-        options = found_orders + [user_input_raw]
-
-        buttons = []
-        for opt in options:
-            cb_data = f"order:{opt[:50]}"
-            buttons.append([InlineKeyboardButton(text=opt, callback_data=cb_data)])
-
-        keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
+        # В FSM — только ID записей и названия; кнопки ссылаются на номер варианта.
+        # Одинаковые запросы разных пользователей берутся из кэша результатов
+        options = [
+            {"id": record_id, "name": name}
+            for record_id, name in await orders_cache.search(user_input_norm, ORDER_RESULTS_LIMIT)
+        ]
+        options.append({"id": None, "name": user_input_raw})
+
         try:
-            await message.answer("Выберите заказ:", reply_markup=keyboard)
+            await message.answer("Выберите заказ:", reply_markup=order_options_kb(options, 0))
             await state.update_data(order_options=options)
             await state.set_state(PaymentForm.order_selection)
         except Exception as send_error:
@@ -206,10 +395,26 @@ async def process_order(message: Message, state: FSMContext):
         await state.update_data(order=user_input_raw)
         await _save_data_and_finish(message.bot, message.from_user, state)
 
-# === ХЕНДЛЕР INLINE-ВЫБОРА ===
+# === ХЕНДЛЕРЫ INLINE-ВЫБОРА ===
+@router.callback_query(PaymentForm.order_selection, F.data.startswith("order_page:"))
+async def handle_order_page(callback: CallbackQuery, state: FSMContext):
+    page = callback.data[len("order_page:"):]
+    if page.isdigit():
+        data = await state.get_data()
+        await callback.message.edit_reply_markup(
+            reply_markup=order_options_kb(data.get("order_options") or [], int(page))
+        )
+    await callback.answer()
+
 @router.callback_query(PaymentForm.order_selection, F.data.startswith("order:"))
 async def handle_order_selection(callback: CallbackQuery, state: FSMContext):
     selected = callback.data[len("order:"):]
+    options = (await state.get_data()).get("order_options") or []
+    if selected.isdigit() and int(selected) < len(options) and isinstance(options[int(selected)], dict):
+        option = options[int(selected)]
+        # Название берём из кэша по ID записи: заказ могли переименовать, пока шёл выбор
+        selected = (option["id"] and orders_cache.order_name(option["id"])) or option["name"]
+    # Иначе — кнопка из диалога, начатого до перехода на ID: в ней само название
     await state.update_data(order=selected)
     await callback.answer()
     await _save_data_and_finish(callback.bot, callback.from_user, state)
@@ -230,24 +435,38 @@ async def _save_data_and_finish(bot: Bot, user, state: FSMContext):
         if data.get('order'):
             fields["Заказ"] = data.get('order')
 
-        attachment_value = []
-        file_id = data.get('attachment')
-        if file_id:
-            try:
-                file = await bot.get_file(file_id)
-                file_url = f"https://api.telegram.org/file/bot{TELEGRAM_BOT_TOKEN}/{file.file_path}"
-                attachment_value = [{"url": file_url}]
-                fields["Вложение"] = attachment_value
-            except Exception as e:
-                logger.error(f"Ошибка при получении ссылки на файл: {e}")
+        attachments = data.get('attachments')
+        if attachments is None:
+            # Диалог начат до поддержки альбомов — там одно вложение,
+            # а ещё раньше хранился только file_id
+            attachment = data.get('attachment')
+            if isinstance(attachment, str):
+                attachment = {"file_id": attachment}
+            attachments = [attachment] if attachment else []
 
-        await airtable_client.create_record(fields)
+        # Запись считается принятой, как только сохранена локально;
+        # в Airtable её отправит фоновая очередь, а вложение загрузится следом.
+        # Повтор той же оплаты (двойное нажатие, повторная доставка) новую запись не создаёт
+        entry = await outbox.put(
+            fields, chat_id=user.id, attachments=attachments or None,
+            idempotency_key=payment_key(user.id, data.get('dialog_id'))
+        )
+        if not entry.created:
+            await bot.send_message(
+                chat_id=user.id,
+                text=(
+                    f"ℹ️ Эта оплата уже сохранена (<code>{entry.record_id}</code>)" if entry.record_id
+                    else "ℹ️ Эта оплата уже сохранена и отправляется в Airtable"
+                ),
+                reply_markup=main_kb
+            )
+            return
 
-        result_lines = ["✅ Запись добавлена:\n"]
+        result_lines = ["✅ Запись сохранена:\n"]
         if data.get('order'):
             result_lines.append(f"<b>Заказ:</b> {data.get('order')}")
-        if file_id:
-            result_lines.append(f"<b>Вложение:</b> 📎")
+        if attachments:
+            result_lines.append(f"<b>Вложение:</b> {'📎' * len(attachments)}")
         if data.get('amount'):
             result_lines.append(f"<b>Сумма:</b> {data.get('amount')}")
         if data.get('note'):
@@ -265,7 +484,15 @@ async def _save_data_and_finish(bot: Bot, user, state: FSMContext):
         logger.error(f"Ошибка при сохранении данных: {e}", exc_info=True)
         await bot.send_message(
             chat_id=user.id,
-            text=f"Произошла ошибка при сохранении в Airtable:\n<code>{str(e)}</code>"
+            text=f"Произошла ошибка при сохранении:\n<code>{str(e)}</code>"
         )
     finally:
         await state.clear()
+
+async def notify_airtable_result(bot: Bot, chat_id: int, record_id, error):
+    """Сообщает пользователю, дошла ли запись из очереди до Airtable."""
+    if error:
+        text = f"❌ Ошибка при сохранении в Airtable:\n<code>{html.escape(str(error))}</code>"
+    else:
+        text = "☁️ Запись добавлена в Airtable"
+    await bot.send_message(chat_id=chat_id, text=text)
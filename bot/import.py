@@ -0,0 +1,53 @@
+# bot/import.py
+"""Импорт оплат из банковской выписки (CSV/XLSX) в Airtable.
+
+Запуск: python -m bot.import выписка.csv [--sender "Бухгалтерия"] [--dry-run]
+
+Строки с точно совпавшим кодом заказа записываются пачками по 10, остальные
+попадают в отчёт <файл>.flagged.csv для ручной проверки. Прерванный импорт
+того же файла продолжается с места остановки, без повторных записей.
+"""
+import argparse
+import asyncio
+import logging
+import sys
+from pathlib import Path
+from .airtable_client import AirtableClient
+from .cache_manager import OrdersCache
+from .payment_import import ImportFileError, PaymentImport
+
+
+async def run(path: Path, sender: str, dry_run: bool) -> int:
+    client = AirtableClient()
+    orders = OrdersCache(client)
+    try:
+        await orders.warm()
+        data = await asyncio.to_thread(path.read_bytes)
+        report = await PaymentImport(client, orders, data, path.name, sender, dry_run=dry_run).run()
+    except ImportFileError as e:
+        print(f"❌ {e}", file=sys.stderr)
+        return 2
+    finally:
+        await orders.stop()
+        await client.close()
+
+    print(report.summary())
+    if report.flagged or report.failed:
+        flagged_path = path.with_name(f"{path.stem}.flagged.csv")
+        await asyncio.to_thread(flagged_path.write_bytes, report.flagged_csv())
+        print(f"Строки для проверки: {flagged_path}")
+    return 1 if report.failed else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("file", type=Path, help="выписка CSV или XLSX")
+    parser.add_argument("--sender", default="Импорт выписки", help="значение поля «Отправитель»")
+    parser.add_argument("--dry-run", action="store_true", help="только подобрать заказы, ничего не записывать")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(name)s - %(message)s")
+    sys.exit(asyncio.run(run(args.file, args.sender, args.dry_run)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+# bot/inline_orders.py
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List, Tuple
+from aiogram.types import InlineQueryResultArticle, InputTextMessageContent
+from .metrics import INLINE_EVENTS
+
+# Telegram показывает не больше 50 результатов на один ответ
+INLINE_RESULTS_LIMIT = 50
+# Запросы короче этого не ищутся: совпадение с одной буквой есть почти у каждого заказа
+INLINE_MIN_QUERY_LENGTH = 2
+
+logger = logging.getLogger(__name__)
+
+
+class InlineDebouncer:
+    """По одной отложенной задаче на пользователя: новый запрос отменяет прежний.
+
+    Telegram присылает inline-запрос почти на каждый введённый символ, а
+    отвечать имеет смысл только на последний. Хендлер сразу возвращается,
+    поэтому ожидание не задерживает другие обновления.
+    """
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self._tasks: Dict[int, asyncio.Task] = {}
+
+    def schedule(self, user_id: int, job: Callable[[], Awaitable[None]]):
+        previous = self._tasks.get(user_id)
+        if previous is not None and not previous.done():
+            previous.cancel()
+            INLINE_EVENTS.inc("superseded")
+        task = asyncio.create_task(self._run(user_id, job))
+        self._tasks[user_id] = task
+
+    async def _run(self, user_id: int, job: Callable[[], Awaitable[None]]):
+        try:
+            if self.delay > 0:
+                await asyncio.sleep(self.delay)
+            await job()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.warning(f"Не удалось ответить на inline-запрос пользователя {user_id}: {e}")
+        finally:
+            if self._tasks.get(user_id) is asyncio.current_task():
+                del self._tasks[user_id]
+
+
+def order_results(orders: List[Tuple[str, str]]) -> List[InlineQueryResultArticle]:
+    """Результаты для выбора заказа ([(ID записи, название)]): при выборе в чат уходит точное название."""
+    return [
+        InlineQueryResultArticle(
+            id=record_id or str(i),
+            title=name,
+            # Без разметки: в названиях заказов бывают символы < и &
+            input_message_content=InputTextMessageContent(message_text=name, parse_mode=None)
+        )
+        for i, (record_id, name) in enumerate(orders)
+    ]
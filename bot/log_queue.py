@@ -0,0 +1,154 @@
+# bot/log_queue.py
+import copy
+import json
+import logging
+import queue
+import threading
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Dict, List, Optional
+from aiogram import BaseMiddleware
+from .metrics import LOG_DROPPED
+
+# Контекст текущего обновления для журнала: update_id, пользователь, состояние диалога.
+# Задачи, запущенные из хендлера (asyncio.create_task), получают копию контекста
+log_context: ContextVar[Optional[Dict[str, Any]]] = ContextVar("log_context", default=None)
+CONTEXT_FIELDS = ("update_id", "user_id", "state")
+
+_exception_formatter = logging.Formatter()
+
+
+class ContextFilter(logging.Filter):
+    """Добавляет к записи поля контекста обновления (в потоке, где вызван logger)."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        context = log_context.get() or {}
+        for field in CONTEXT_FIELDS:
+            setattr(record, field, context.get(field))
+        record.context = (
+            " [" + " ".join(f"{field}={context[field]}" for field in CONTEXT_FIELDS if context.get(field) is not None) + "]"
+            if context else ""
+        )
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+    """Одна запись — одна строка JSON (JSON lines)."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class BoundedQueueHandler(QueueHandler):
+    """QueueHandler с ограниченной очередью, который никогда не ждёт.
+
+    Если очередь полна (диск не успевает, шторм ошибок), запись отбрасывается
+    и учитывается; как только место появится, в журнал уходит одна сводка
+    «пропущено N записей» по уровням. Хендлеры бота при этом не блокируются.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self._dropped: Dict[str, int] = {}
+        self._dropped_lock = threading.Lock()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Сообщение и traceback собираются здесь, пока живы аргументы и exc_info;
+        # строка журнала (текст или JSON) форматируется уже в потоке QueueListener
+        message = record.getMessage()
+        exc_text = record.exc_text
+        if record.exc_info and not exc_text:
+            exc_text = _exception_formatter.formatException(record.exc_info)
+        record = copy.copy(record)
+        record.message = record.msg = message
+        record.args = None
+        record.exc_info = None
+        record.exc_text = exc_text
+        return record
+
+    def emit(self, record: logging.LogRecord):
+        if self._dropped and not self._flush_dropped():
+            self._drop(record)
+            return
+        try:
+            self.enqueue(self.prepare(record))
+        except queue.Full:
+            self._drop(record)
+        except Exception:
+            self.handleError(record)
+
+    def _drop(self, record: logging.LogRecord):
+        with self._dropped_lock:
+            self._dropped[record.levelname] = self._dropped.get(record.levelname, 0) + 1
+        LOG_DROPPED.inc(record.levelname)
+
+    def _flush_dropped(self) -> bool:
+        """Ставит в очередь сводку об отброшенных записях; False — места всё ещё нет."""
+        with self._dropped_lock:
+            dropped, self._dropped = self._dropped, {}
+        summary = logging.LogRecord(
+            __name__, logging.WARNING, __file__, 0,
+            "Очередь журнала переполнена, пропущено записей: %s" % ", ".join(
+                f"{level} {count}" for level, count in sorted(dropped.items())
+            ), None, None
+        )
+        summary.context = ""
+        for field in CONTEXT_FIELDS:
+            setattr(summary, field, None)
+        try:
+            self.enqueue(summary)
+            return True
+        except queue.Full:
+            with self._dropped_lock:
+                for level, count in dropped.items():
+                    self._dropped[level] = self._dropped.get(level, 0) + count
+            return False
+
+
+class _Listener(QueueListener):
+    def enqueue_sentinel(self):
+        # При остановке ждём места в очереди: все записи до неё должны попасть в журнал
+        self.queue.put(self._sentinel)
+
+
+def start_queue_logging(handlers: List[logging.Handler], queue_size: int) -> QueueListener:
+    """Подключает к корневому логгеру очередь, а handlers — к потоку QueueListener."""
+    log_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+    queue_handler = BoundedQueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+    logging.getLogger().addHandler(queue_handler)
+    listener = _Listener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+class LogContextMiddleware(BaseMiddleware):
+    """Outer middleware на update: update_id, пользователь и состояние диалога в каждой записи журнала."""
+
+    async def __call__(self, handler, event, data: Dict[str, Any]):
+        user = data.get("event_from_user")
+        token = log_context.set({
+            "update_id": getattr(event, "update_id", None),
+            "user_id": user.id if user is not None else None,
+            # raw_state уже прочитано из хранилища FSMContextMiddleware
+            "state": data.get("raw_state")
+        })
+        try:
+            return await handler(event, data)
+        finally:
+            log_context.reset(token)
@@ -1,22 +1,59 @@
 # bot/main.py
 import asyncio
+import atexit
 import logging
+import multiprocessing
 import os
+import signal
+import socket
+from functools import partial
 from logging.handlers import RotatingFileHandler
 from aiogram import Bot, Dispatcher
+from aiogram.fsm.storage.base import BaseStorage
 from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiogram.webhook.aiohttp_server import setup_application
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
 from aiohttp import web
-from .config import TELEGRAM_BOT_TOKEN
-from .handlers import router
+from .config import (
+    TELEGRAM_BOT_TOKEN,
+    FSM_STORAGE,
+    FSM_TTL,
+    WEB_WORKERS,
+    LOG_FORMAT,
+    LOG_QUEUE_SIZE,
+    METRICS_ENABLED,
+    METRICS_PATH,
+    METRICS_HOST,
+    METRICS_PORT
+)
+from .fsm_storage import SQLiteStorage, FSM_FILE
+from .dedup import DuplicateUpdateMiddleware
+from .log_queue import JSONFormatter, LogContextMiddleware, start_queue_logging
+from .metrics import MetricsMiddleware, registry, start_metrics_server
+from .update_queue import QueuedRequestHandler
+from .handlers import (
+    router,
+    airtable_client,
+    orders_cache,
+    outbox,
+    payments_replica,
+    attachment_uploader,
+    notify_airtable_result
+)
 
 # Получаем корневой логгер
 logger = logging.getLogger(__name__)
 
-def setup_logging():
-    """Настраивает логирование в файл (с ротацией) и в консоль."""
+# Сколько (в секундах) ждать завершения дочернего webhook-процесса после SIGTERM
+WORKER_STOP_TIMEOUT = 30
+
+def setup_logging(log_file: str = 'bot.log'):
+    """Настраивает логирование в файл (с ротацией) и в консоль.
+
+    Хендлеры лишь кладут записи в очередь: запись на диск и ротация идут в
+    отдельном потоке QueueListener и не задерживают цикл событий.
+    """
     log_level = logging.INFO
     root_logger = logging.getLogger()
     root_logger.setLevel(log_level)
@@ -27,25 +64,25 @@ def setup_logging():
         os.makedirs(log_dir)
 
     log_formatter = logging.Formatter(
-        "%(asctime)s - %(levelname)s - %(name)s - %(message)s"
+        "%(asctime)s - %(levelname)s - %(name)s - %(message)s%(context)s"
     )
 
     # Обработчик для файла — с ротацией
     file_handler = RotatingFileHandler(
-        os.path.join(log_dir, 'bot.log'),  # ← Полный путь к файлу
+        os.path.join(log_dir, log_file),  # ← Полный путь к файлу
         maxBytes=5*1024*1024,
         backupCount=2,
         encoding='utf-8'
     )
-    file_handler.setFormatter(log_formatter)
+    file_handler.setFormatter(JSONFormatter() if LOG_FORMAT == "json" else log_formatter)
 
     # Обработчик для консоли
     console_handler = logging.StreamHandler()
     console_handler.setFormatter(log_formatter)
 
-    # Добавляем обработчики
-    root_logger.addHandler(file_handler)
-    root_logger.addHandler(console_handler)
+    # Обработчики работают в потоке QueueListener; при выходе он дописывает очередь
+    listener = start_queue_logging([file_handler, console_handler], LOG_QUEUE_SIZE)
+    atexit.register(listener.stop)
 
 # Получаем настройки webhook из окружения
 WEBHOOK_HOST = os.getenv("WEBHOOK_HOST")
@@ -54,15 +91,198 @@ WEBHOOK_URL = f"{WEBHOOK_HOST}{WEBHOOK_PATH}" if WEBHOOK_HOST else None
 WEBAPP_HOST = "0.0.0.0"
 WEBAPP_PORT = int(os.getenv("PORT", 8080))
 
+def create_storage() -> BaseStorage:
+    """Выбирает хранилище диалогов по FSM_STORAGE."""
+    if FSM_STORAGE == "memory":
+        return MemoryStorage()
+    if FSM_STORAGE != "sqlite":
+        raise ValueError(f"Неизвестное FSM_STORAGE: {FSM_STORAGE}")
+    return SQLiteStorage(FSM_FILE, ttl=FSM_TTL)
+
 async def on_startup(bot: Bot):
+    await airtable_client.start()
+    # Прогреваем кэш заказов, чтобы первый пользователь не ждал выгрузки из Airtable
+    await orders_cache.warm()
+    orders_cache.start_refresher()
+    # Очередь оплат: досылает записи и вложения, не отправленные до перезапуска
+    attachment_uploader.start(bot, on_done=outbox.attachments_done, on_uploaded=outbox.attachment_uploaded)
+    outbox.start(partial(notify_airtable_result, bot))
+    # Реплику оплат синхронизирует только основной процесс; остальные читают её файл
+    payments_replica.start()
     if WEBHOOK_URL:
         await bot.set_webhook(WEBHOOK_URL)
         logger.info(f"Webhook установлен на {WEBHOOK_URL}")
 
-async def on_shutdown(bot: Bot):
+async def on_shutdown(bot: Bot, dispatcher: Dispatcher):
     if WEBHOOK_URL:
         await bot.delete_webhook()
         logger.info("Webhook удалён")
+    await outbox.stop()
+    await attachment_uploader.stop()
+    await payments_replica.stop()
+    await orders_cache.stop()
+    await airtable_client.close()
+    await dispatcher.storage.close()
+
+async def on_worker_startup(bot: Bot):
+    await airtable_client.start()
+    # Снимок заказов обновляет основной процесс, здесь он только читается
+    orders_cache.follow()
+
+async def on_worker_shutdown(bot: Bot, dispatcher: Dispatcher):
+    # Очередь оплат процесс не отправляет, но записывает в неё — закрываем соединение
+    await outbox.stop()
+    await dispatcher.storage.close()
+    await airtable_client.close()
+    await bot.session.close()
+
+def create_bot() -> Bot:
+    return Bot(
+        token=TELEGRAM_BOT_TOKEN,
+        default=DefaultBotProperties(parse_mode=ParseMode.HTML)
+    )
+
+def create_dispatcher() -> Dispatcher:
+    dp = Dispatcher(storage=create_storage())
+    # Повторно доставленные обновления отсеиваются до любых хендлеров
+    dp.update.outer_middleware(DuplicateUpdateMiddleware())
+    # После FSMContextMiddleware: в контексте журнала уже есть состояние диалога
+    dp.update.outer_middleware(LogContextMiddleware())
+    dp.include_router(router)
+    if METRICS_ENABLED:
+        setup_metrics(dp)
+    return dp
+
+async def _active_dialogs(storage: BaseStorage) -> int:
+    if isinstance(storage, SQLiteStorage):
+        return await storage.count_active()
+    if isinstance(storage, MemoryStorage):
+        return sum(1 for record in storage.storage.values() if record.state is not None)
+    return 0
+
+def setup_metrics(dp: Dispatcher):
+    """Подключает замер хендлеров и показатели, которые считаются только при запросе /metrics."""
+    middleware = MetricsMiddleware()
+    dp.message.middleware(middleware)
+    dp.callback_query.middleware(middleware)
+    dp.inline_query.middleware(middleware)
+
+    registry.gauge("bot_fsm_active_dialogs", "Незавершённые диалоги", partial(_active_dialogs, dp.storage))
+    registry.gauge("bot_orders_cached", "Заказов в кэше", lambda: orders_cache.size)
+    registry.gauge("bot_orders_cache_version", "Версия индекса заказов", lambda: orders_cache.version)
+    registry.gauge(
+        "bot_search_cache_size", "Размер кэшей поиска: результатов — в запросах, слов — в заказах",
+        lambda: {("results",): orders_cache.results_cache_size, ("tokens",): orders_cache.token_cache_size},
+        labels=("cache",)
+    )
+    registry.gauge("bot_outbox_pending", "Записей в очереди оплат", outbox.pending_count)
+    registry.gauge("bot_payments_replica_records", "Оплат в локальной реплике", payments_replica.count)
+    registry.gauge(
+        "bot_airtable_limiter_total", "Счётчики лимитера запросов к Airtable",
+        lambda: {(key,): value for key, value in airtable_client.limiter.stats.items()},
+        labels=("event",), kind="counter"
+    )
+
+def get_web_workers() -> int:
+    if WEB_WORKERS <= 1:
+        return 1
+    if not hasattr(socket, "SO_REUSEPORT"):
+        logger.warning("SO_REUSEPORT не поддерживается в этой ОС — webhook-сервер запускается в одном процессе")
+        return 1
+    if FSM_STORAGE == "memory":
+        logger.warning("Для нескольких процессов нужен FSM_STORAGE=sqlite — webhook-сервер запускается в одном процессе")
+        return 1
+    return WEB_WORKERS
+
+async def start_webhook_server(dp: Dispatcher, bot: Bot, reuse_port: bool) -> web.AppRunner:
+    app = web.Application()
+    # Telegram получает ответ сразу, обновления обрабатываются из очереди
+    handler = QueuedRequestHandler(dispatcher=dp, bot=bot)
+    handler.register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    if METRICS_ENABLED:
+        registry.gauge("bot_update_queue_depth", "Обновлений в очереди webhook", lambda: handler.queue_depth)
+        registry.gauge(
+            "bot_update_queue_total", "Счётчики очереди обновлений webhook",
+            lambda: {(key,): value for key, value in handler.stats.items()},
+            labels=("event",), kind="counter"
+        )
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT, reuse_port=reuse_port or None)
+    await site.start()
+    return runner
+
+def stop_event() -> asyncio.Event:
+    """Событие, которое выставляется по SIGTERM: после него сервер штатно останавливается."""
+    stop = asyncio.Event()
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+    except NotImplementedError:
+        # Windows: обработчиков сигналов в цикле событий нет, остановка — через Ctrl+C
+        pass
+    return stop
+
+def run_worker(worker_id: int):
+    """Точка входа дочернего процесса webhook-сервера."""
+    try:
+        asyncio.run(worker_main(worker_id))
+    except KeyboardInterrupt:
+        pass
+
+async def worker_main(worker_id: int):
+    setup_logging(f'bot.worker{worker_id}.log')
+    logger.info(f"Запуск webhook-процесса #{worker_id}...")
+    bot = create_bot()
+    dp = create_dispatcher()
+    dp.startup.register(on_worker_startup)
+    dp.shutdown.register(on_worker_shutdown)
+    stop = stop_event()
+    runner = await start_webhook_server(dp, bot, reuse_port=True)
+    try:
+        if METRICS_ENABLED and METRICS_PORT:
+            # /metrics общего порта попадает в случайный процесс — у каждого есть свой порт
+            await start_metrics_server(METRICS_HOST, METRICS_PORT + worker_id, METRICS_PATH)
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+        logger.info(f"Webhook-процесс #{worker_id} остановлен")
+
+async def supervise_workers(count: int, stop: asyncio.Event):
+    """Запускает дочерние webhook-процессы и перезапускает упавшие, пока не выставлен stop.
+
+    При остановке каждому процессу отправляется SIGTERM, и супервизор ждёт,
+    пока они доработают принятые обновления (не дольше WORKER_STOP_TIMEOUT).
+    """
+    ctx = multiprocessing.get_context("spawn")
+    workers = {}
+    try:
+        while not stop.is_set():
+            for worker_id in range(1, count):
+                process = workers.get(worker_id)
+                if process is not None and process.is_alive():
+                    continue
+                if process is not None:
+                    logger.warning(f"Webhook-процесс #{worker_id} завершился с кодом {process.exitcode}, перезапуск")
+                process = ctx.Process(target=run_worker, args=(worker_id,), daemon=True)
+                process.start()
+                workers[worker_id] = process
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=5)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        for process in workers.values():
+            if process.is_alive():
+                process.terminate()
+        for worker_id, process in workers.items():
+            await asyncio.to_thread(process.join, WORKER_STOP_TIMEOUT)
+            if process.is_alive():
+                logger.warning(
+                    f"Webhook-процесс #{worker_id} не завершился за {WORKER_STOP_TIMEOUT} с, принудительная остановка"
+                )
+                process.kill()
+                await asyncio.to_thread(process.join)
 
 async def main():
     # ⚡️ Первая команда в main() — настройка логирования!
@@ -70,31 +290,37 @@ async def main():
     logger.info("Запуск бота...")
 
     try:
-        bot = Bot(
-            token=TELEGRAM_BOT_TOKEN,
-            default=DefaultBotProperties(parse_mode=ParseMode.HTML)
-        )
-        dp = Dispatcher(storage=MemoryStorage())
-
-        dp.include_router(router)
+        bot = create_bot()
+        dp = create_dispatcher()
 
         dp.startup.register(on_startup)
         dp.shutdown.register(on_shutdown)
 
         if WEBHOOK_URL:
             # Режим Webhook
-            app = web.Application()
-            SimpleRequestHandler(dispatcher=dp, bot=bot).register(app, path=WEBHOOK_PATH)
-            setup_application(app, dp, bot=bot)
-            logger.info(f"Запуск webhook-сервера на {WEBAPP_HOST}:{WEBAPP_PORT}")
-            runner = web.AppRunner(app)
-            await runner.setup()
-            site = web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT)
-            await site.start()
-            await asyncio.Event().wait()
+            workers = get_web_workers()
+            logger.info(f"Запуск webhook-сервера на {WEBAPP_HOST}:{WEBAPP_PORT} (процессов: {workers})")
+            stop = stop_event()
+            runner = await start_webhook_server(dp, bot, reuse_port=workers > 1)
+            try:
+                # Метрики — только на отдельном внутреннем порту, не на публичном webhook
+                if METRICS_ENABLED and METRICS_PORT:
+                    await start_metrics_server(METRICS_HOST, METRICS_PORT, METRICS_PATH)
+                    logger.info(f"Метрики доступны на http://{METRICS_HOST}:{METRICS_PORT}{METRICS_PATH}")
+                if workers > 1:
+                    await supervise_workers(workers, stop)
+                else:
+                    await stop.wait()
+            finally:
+                # При остановке (SIGTERM, Ctrl+C, служба WinSW) дорабатываем обновления, на которые
+                # Telegram уже получил 200, и вызываем on_shutdown диспетчера
+                await runner.cleanup()
         else:
             # Режим Polling
             logger.info("Запуск polling...")
+            if METRICS_ENABLED and METRICS_PORT:
+                await start_metrics_server(METRICS_HOST, METRICS_PORT, METRICS_PATH)
+                logger.info(f"Метрики доступны на http://{METRICS_HOST}:{METRICS_PORT}{METRICS_PATH}")
             await dp.start_polling(bot)
 
     except Exception as e:
@@ -0,0 +1,215 @@
+# bot/metrics.py
+import inspect
+import time
+from bisect import bisect_left
+from typing import Any, Awaitable, Callable, Dict, List, Sequence, Tuple, Union
+from aiogram import BaseMiddleware
+from aiohttp import web
+
+# Границы корзин гистограмм по умолчанию (секунды)
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def collect(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for labels, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.buckets = tuple(buckets)
+        # Для каждого набора меток: счётчики по корзинам (+Inf последней), сумма
+        self._values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, *labels: str):
+        series = self._values.get(labels)
+        if series is None:
+            series = self._values[labels] = ([0] * (len(self.buckets) + 1), [0.0])
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1][0] += value
+
+    def collect(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, labels, le)} {cumulative}")
+            label_text = _format_labels(self.label_names, labels)
+            lines.append(f"{self.name}_sum{label_text} {_format_value(total[0])}")
+            lines.append(f"{self.name}_count{label_text} {cumulative}")
+        return lines
+
+
+GaugeValue = Union[float, Dict[LabelValues, float]]
+
+
+class Gauge:
+    """Значение вычисляется только при запросе /metrics (функция может быть async).
+
+    kind="counter" — для счётчиков, которые уже ведёт сам объект (например, RateLimiter.stats).
+    """
+
+    def __init__(self, name: str, documentation: str, func: Callable[[], Union[GaugeValue, Awaitable[GaugeValue]]],
+                 labels: Sequence[str] = (), kind: str = "gauge"):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.func = func
+        self.kind = kind
+
+    async def collect_async(self) -> List[str]:
+        value = self.func()
+        if inspect.isawaitable(value):
+            value = await value
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        items = value.items() if isinstance(value, dict) else [((), value)]
+        for labels, item in items:
+            lines.append(f"{self.name}{_format_labels(self.label_names, labels)} {_format_value(item)}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Union[Counter, Histogram, Gauge]] = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labels))
+
+    def histogram(self, name: str, documentation: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def gauge(self, name: str, documentation: str, func, labels: Sequence[str] = (), kind: str = "gauge") -> Gauge:
+        return self.register(Gauge(name, documentation, func, labels, kind))
+
+    async def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            if isinstance(metric, Gauge):
+                lines.extend(await metric.collect_async())
+            else:
+                lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+HANDLER_SECONDS = registry.histogram(
+    "bot_handler_seconds", "Время работы хендлера", labels=("handler", "status")
+)
+SEARCH_SECONDS = registry.histogram("bot_order_search_seconds", "Время поиска заказа")
+SEARCH_CANDIDATES = registry.histogram(
+    "bot_order_search_candidates", "Кандидатов после фильтра по индексу",
+    buckets=(0, 10, 50, 100, 500, 1000, 5000, 10000, 50000, 100000)
+)
+AIRTABLE_SECONDS = registry.histogram(
+    "bot_airtable_request_seconds", "Время запроса к Airtable", labels=("method", "status")
+)
+AIRTABLE_RETRIES = registry.counter(
+    "bot_airtable_retries_total", "Повторы запросов к Airtable", labels=("reason",)
+)
+ORDERS_CACHE_EVENTS = registry.counter(
+    "bot_orders_cache_total", "Обращения к кэшу заказов и его обновления", labels=("event",)
+)
+SEARCH_CACHE_EVENTS = registry.counter(
+    "bot_search_cache_total", "Кэши поиска заказов: попадания, промахи, вытеснения, истёкшие записи",
+    labels=("cache", "event")
+)
+INLINE_SECONDS = registry.histogram(
+    "bot_inline_query_seconds", "Время ответа на inline-запрос (без паузы debounce)"
+)
+INLINE_EVENTS = registry.counter(
+    "bot_inline_queries_total", "Inline-запросы: отвечено, отменено новым запросом, превышен бюджет",
+    labels=("event",)
+)
+PAYMENTS_REPLICA_EVENTS = registry.counter(
+    "bot_payments_replica_total", "Реплика оплат: синхронизации, ошибки, записи через write-through",
+    labels=("event",)
+)
+DUPLICATES_SUPPRESSED = registry.counter(
+    "bot_duplicates_suppressed_total", "Подавленные повторы: update — повторная доставка, payment — повторная запись оплаты",
+    labels=("kind",)
+)
+LOG_DROPPED = registry.counter(
+    "bot_log_records_dropped_total", "Записи журнала, отброшенные при переполнении очереди", labels=("level",)
+)
+UPDATE_QUEUE_WAIT = registry.histogram(
+    "bot_update_queue_wait_seconds", "Ожидание обновления в очереди webhook"
+)
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Замеряет время каждого хендлера (inner middleware на message/callback_query)."""
+
+    async def __call__(self, handler, event, data: Dict[str, Any]):
+        handler_object = data.get("handler")
+        name = getattr(getattr(handler_object, "callback", None), "__name__", "unknown")
+        started = time.perf_counter()
+        status = "ok"
+        try:
+            return await handler(event, data)
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, name, status)
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(text=await registry.render(), content_type="text/plain", charset="utf-8",
+                        headers={"X-Content-Type-Options": "nosniff"})
+
+
+def setup_metrics_route(app: web.Application, path: str = "/metrics"):
+    app.router.add_get(path, metrics_handler)
+
+
+async def start_metrics_server(host: str, port: int, path: str = "/metrics") -> web.AppRunner:
+    """Отдельный небольшой HTTP-сервер с /metrics на внутреннем адресе."""
+    app = web.Application()
+    setup_metrics_route(app, path)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,104 @@
+# bot/order_codes.py
+import re
+from typing import Iterator, List, NamedTuple, Optional
+
+# Латинские буквы, которые пишут вместо похожих кириллических (AOC-0125 → АОС-0125),
+# и дефисы/тире, которые встречаются в кодах вместо обычного "-"
+_NORMALIZE = str.maketrans({
+    "A": "А", "B": "В", "C": "С", "E": "Е", "H": "Н", "K": "К", "M": "М",
+    "O": "О", "P": "Р", "T": "Т", "X": "Х", "Y": "У",
+    "‐": "-", "‑": "-", "‒": "-", "–": "-", "—": "-", "−": "-"
+})
+
+# Код заказа: 2–4 буквы, номер из 3–6 цифр и необязательные части через дефис
+# (ТЭС-3324-4). Между буквами и номером допускаются дефис и пробелы
+CODE_RE = re.compile(r"([А-ЯЁ]{2,4})[\s\-_]*(\d{3,6})((?:-\d+)*)(?!\d)")
+# Во вводе пользователя номер может быть набран не до конца (АОС-01)
+QUERY_CODE_RE = re.compile(r"(?<![А-ЯЁ\d])([А-ЯЁ]{2,4})[\s\-_]*(\d{1,6})((?:-\d+)*)(?![\dА-ЯЁ])")
+# Код ищется только в начале названия — дальше разбирать строку незачем
+CODE_SCAN_LENGTH = 32
+
+_LETTERS = "АБВГДЕЁЖЗИЙКЛМНОПРСТУФХЦЧШЩЪЫЬЭЮЯ"
+_LETTER_CODES = {letter: i + 1 for i, letter in enumerate(_LETTERS)}
+MAX_CODE_DIGITS = 6
+# Маски первых n цифр номера в упакованном виде (по 4 бита на цифру)
+_DIGIT_MASKS = [((1 << 4 * n) - 1) << 4 * (MAX_CODE_DIGITS - n) for n in range(MAX_CODE_DIGITS + 1)]
+
+
+class OrderCode(NamedTuple):
+    prefix: str
+    number: str
+    suffix: str
+
+    @property
+    def text(self) -> str:
+        return f"{self.prefix}-{self.number}{self.suffix}"
+
+
+def normalize_code_text(text: str) -> str:
+    """Верхний регистр, кириллица вместо похожей латиницы и обычные дефисы."""
+    return text.upper().translate(_NORMALIZE)
+
+
+def parse_order_code(name: str) -> Optional[OrderCode]:
+    """Код в начале названия заказа ("АОС-0125 Белые окна" → АОС-0125)."""
+    match = CODE_RE.match(normalize_code_text(name.lstrip()[:CODE_SCAN_LENGTH]))
+    if match is None:
+        return None
+    return OrderCode(*match.groups())
+
+
+def parse_query(query: str):
+    """Разбирает ввод на код заказа (возможно, неполный) и остальные слова.
+
+    Возвращает (OrderCode или None, список оставшихся слов в нижнем регистре).
+    Код распознаётся только вместе с цифрами: одни буквы («дом», «мо») — обычный текст.
+    """
+    normalized = normalize_code_text(query)
+    match = QUERY_CODE_RE.search(normalized)
+    if match is None:
+        return None, query.lower().split()
+    # upper() может изменить длину строки (ß → SS) — тогда остаток берётся из нормализованной
+    source = query if len(normalized) == len(query) else normalized
+    rest = (source[:match.start()] + " " + source[match.end():]).lower().split()
+    return OrderCode(*match.groups()), rest
+
+
+def find_order_codes(text: str) -> List[OrderCode]:
+    """Все полные коды заказов в свободном тексте ("Оплата по сч. АОС-0125 от 01.03" → [АОС-0125])."""
+    codes = []
+    for match in QUERY_CODE_RE.finditer(normalize_code_text(text)):
+        code = OrderCode(*match.groups())
+        # Полный номер — от 3 цифр: «НДС 20» кодом заказа не считается
+        if len(code.number) >= 3 and code not in codes:
+            codes.append(code)
+    return codes
+
+
+def _prefix_bits(prefix: str) -> int:
+    key = 0
+    for letter in prefix.ljust(4, "\0"):
+        key = (key << 6) | _LETTER_CODES.get(letter, 0)
+    return key << 3
+
+
+def _digits_bits(digits: str) -> int:
+    # Десятичные цифры, прочитанные как шестнадцатеричное число, — это и есть 4 бита на цифру
+    return (len(digits) << 24) | int(digits.ljust(MAX_CODE_DIGITS, "0"), 16)
+
+
+def code_key(prefix: str, digits: str) -> int:
+    """Ключ кода (или его начала) для хэш-индекса: буквы и цифры, упакованные в u64.
+
+    По 6 бит на букву (до 4), 3 бита на число цифр и по 4 бита на цифру (до 6) —
+    ключи разных кодов не совпадают, и их можно хранить в файле индекса.
+    """
+    return (_prefix_bits(prefix) << 24) | _digits_bits(digits)
+
+
+def code_prefix_keys(code: OrderCode) -> Iterator[int]:
+    """Ключи всех начал номера: АОС-0, АОС-01, АОС-012, АОС-0125."""
+    letters = _prefix_bits(code.prefix) << 24
+    digits = int(code.number.ljust(MAX_CODE_DIGITS, "0"), 16)
+    for length in range(1, len(code.number) + 1):
+        yield letters | (length << 24) | (digits & _DIGIT_MASKS[length])
@@ -0,0 +1,450 @@
+# bot/order_index.py
+import heapq
+import itertools
+import mmap
+import os
+import struct
+import time
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple
+import numpy as np
+from rapidfuzz import process as fuzz_process, fuzz
+from .config import SEARCH_TOKEN_CACHE_SIZE
+from .metrics import SEARCH_CANDIDATES, SEARCH_SECONDS
+from .order_codes import OrderCode, code_key, code_prefix_keys, parse_order_code, parse_query
+from .search_cache import LRUCache
+
+SCORE_CUTOFF = 80
+NGRAM_SIZE = 2
+# Для токенов и названий короче этой длины биграммный фильтр не гарантирует
+# полноту (partial_ratio >= 80 возможен без общей биграммы), поэтому такие
+# токены проверяются по всем кандидатам, а такие названия — всегда кандидаты.
+MIN_FILTER_LEN = 4
+# По сколько кандидатов проверять за раз в поиске с ограничением по времени
+BUDGET_CHUNK = 2048
+
+# Снимок заказов на диске; он же общий индекс для нескольких процессов (через mmap).
+# Формат: заголовок, затем секции, выровненные по 8 байт, в порядке байтов машины:
+# смещения и UTF-8 ID записей, смещения и UTF-8 названий, смещения и UTF-8
+# нормализованных названий, ключи биграмм (u64, по возрастанию), смещения и
+# списки заказов по биграммам, номера коротких названий, ключи кодов заказов
+# (u64, по возрастанию), смещения и списки заказов по кодам.
+# В заголовке — версия индекса и время последней (и последней полной) синхронизации.
+INDEX_MAGIC = b"AKOI"
+INDEX_FORMAT = 3
+_HEADER = struct.Struct("=4sIQdd9I")
+
+
+def _ngrams(text: str) -> Set[str]:
+    return {text[i:i + NGRAM_SIZE] for i in range(len(text) - NGRAM_SIZE + 1)}
+
+
+def _gram_key(gram: str) -> int:
+    return (ord(gram[0]) << 32) | ord(gram[1])
+
+
+def _token_cache() -> LRUCache:
+    # Размер — общее число заказов во всех сохранённых списках совпадений
+    return LRUCache("tokens", SEARCH_TOKEN_CACHE_SIZE, weigh=lambda matches: len(matches[0]))
+
+
+class OrderIndex:
+    """Поисковый индекс по названиям заказов, строится один раз на обновление кэша."""
+
+    def __init__(self, names: List[str], record_ids: Optional[List[str]] = None):
+        self.names = list(names)
+        self.record_ids = list(record_ids) if record_ids is not None else [""] * len(self.names)
+        self.names_lower = [name.lower() for name in self.names]
+        self._postings: Dict[str, List[int]] = {}
+        self._short: List[int] = []
+        # Ключ кода или его начала (code_key) → номера заказов
+        self._codes: Dict[int, List[int]] = {}
+        # (код, слово) → заказы, где нашлось слово, и оценки; живёт, пока жив индекс
+        self._matches = _token_cache()
+
+        for i, name in enumerate(self.names_lower):
+            code = parse_order_code(name)
+            if code is not None:
+                for key in code_prefix_keys(code):
+                    self._codes.setdefault(key, []).append(i)
+            if len(name) < MIN_FILTER_LEN:
+                self._short.append(i)
+                continue
+            for gram in _ngrams(name):
+                self._postings.setdefault(gram, []).append(i)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    @property
+    def token_cache_size(self) -> int:
+        """Размер кэша совпадений слов (в заказах)."""
+        return self._matches.size
+
+    def name(self, i: int) -> str:
+        return self.names[i]
+
+    def record_id(self, i: int) -> str:
+        return self.record_ids[i]
+
+    def records(self) -> Dict[str, str]:
+        """ID записи → название заказа."""
+        return dict(zip(self.record_ids, self.names))
+
+    def name_lower(self, i: int) -> str:
+        return self.names_lower[i]
+
+    def _gram_postings(self, gram: str) -> Sequence[int]:
+        return self._postings.get(gram, ())
+
+    def _short_ids(self) -> Sequence[int]:
+        return self._short
+
+    def _code_postings(self, key: int) -> Sequence[int]:
+        return self._codes.get(key, ())
+
+    def code_candidates(self, code: OrderCode) -> List[int]:
+        """Заказы, код которых начинается с code (поиск по хэш-индексу, без перебора)."""
+        ids = self._code_postings(code_key(code.prefix, code.number))
+        if code.suffix:
+            # Части после номера (ТЭС-3324-4) в индекс не входят — сверяем по названию
+            return [i for i in ids if parse_order_code(self.name_lower(i)).text.startswith(code.text)]
+        return list(ids)
+
+    def _candidates_for(self, token: str) -> Set[int]:
+        """Заказы, у которых есть хотя бы одна общая с токеном биграмма."""
+        candidates = set(self._short_ids())
+        for gram in _ngrams(token):
+            candidates.update(self._gram_postings(gram))
+        return candidates
+
+    def candidates(self, tokens: List[str]) -> List[int]:
+        """Сужает список заказов по инвертированному индексу (без потери совпадений)."""
+        candidates: Optional[Set[int]] = None
+        for token in sorted(set(tokens), key=len, reverse=True):
+            if len(token) < MIN_FILTER_LEN:
+                continue
+            token_candidates = self._candidates_for(token)
+            candidates = token_candidates if candidates is None else candidates & token_candidates
+            if not candidates:
+                return []
+        if candidates is None:
+            return list(range(len(self)))
+        return sorted(candidates)
+
+    def _score(self, tokens: List[str], candidate_ids: Sequence[int]):
+        """Нормализованные названия кандидатов и оценки cdist (токены × кандидаты)."""
+        choices = [self.name_lower(i) for i in candidate_ids]
+        scores = fuzz_process.cdist(
+            tokens,
+            choices,
+            scorer=fuzz.partial_ratio,
+            score_cutoff=SCORE_CUTOFF
+        )
+        return choices, scores
+
+    def _resolve(self, query: str):
+        """Код заказа из запроса, слова для нечёткого поиска и заказы с этим кодом.
+
+        Если во вводе есть код и он нашёлся в индексе, нечётко сравниваются только
+        остальные слова. Иначе код не используется: весь ввод — обычные слова.
+        """
+        code, rest = parse_query(query)
+        if code is not None:
+            code_ids = self.code_candidates(code)
+            if code_ids:
+                return code, rest, code_ids
+        return None, query.lower().split(), None
+
+    def _token_matches(self, token: str, code: Optional[OrderCode], code_ids: Optional[List[int]],
+                       compute: bool = True):
+        """Заказы, в которых нашлось слово, и их оценки (numpy-массивы), из кэша слов.
+
+        Слово сравнивается со всеми заказами, где оно может найтись: с кодом code,
+        а без кода — со всеми его биграммными кандидатами. Поэтому список полный
+        и годится для любого следующего запроса с этим словом и кодом.
+        """
+        key = (code.text if code is not None else None, token)
+        matches = self._matches.get(key)
+        if matches is None and compute:
+            universe = code_ids if code is not None else sorted(self._candidates_for(token))
+            ids = np.array(universe, dtype=np.uint32)
+            _, scores = self._score([token], universe)
+            hit = (scores[0] >= SCORE_CUTOFF).nonzero()[0]
+            matches = (ids[hit], scores[0][hit])
+            self._matches.put(key, matches)
+        return matches
+
+    def _chunks(self, query: str, budget: Optional[float]) -> Iterator[tuple]:
+        """Совпавшие заказы частями: (номера, нормализованные названия, средние оценки
+        слов, позиции совпавших в части, код из запроса).
+
+        Длинные слова (и все слова при найденном коде) берутся из кэша слов: их
+        пересечение сразу даёт кандидатов. Без budget недостающие списки считаются
+        и кэшируются; с budget — нет, такие слова проверяются частями по
+        BUDGET_CHUNK, как и короткие.
+        """
+        code, tokens, code_ids = self._resolve(query)
+        ids = total = None
+        rest: List[str] = []
+        for token, count in sorted(Counter(tokens).items(), key=lambda item: len(item[0]), reverse=True):
+            matches = None
+            if code is not None or len(token) >= MIN_FILTER_LEN:
+                matches = self._token_matches(token, code, code_ids, compute=budget is None)
+            if matches is None:
+                rest.extend([token] * count)
+                continue
+            token_ids, token_scores = matches
+            if ids is None:
+                ids, total = token_ids, token_scores * count
+            else:
+                ids, left, right = np.intersect1d(ids, token_ids, assume_unique=True, return_indices=True)
+                total = total[left] + token_scores[right] * count
+            if not len(ids):
+                SEARCH_CANDIDATES.observe(0)
+                return
+
+        if ids is not None:
+            candidate_ids = ids.tolist()
+        elif code is not None:
+            candidate_ids = code_ids
+        else:
+            candidate_ids = self.candidates(rest)
+        if total is None:
+            total = np.zeros(len(candidate_ids), dtype=np.float32)
+        SEARCH_CANDIDATES.observe(len(candidate_ids))
+
+        step = BUDGET_CHUNK if budget is not None else max(1, len(candidate_ids))
+        for offset in range(0, len(candidate_ids), step):
+            chunk = candidate_ids[offset:offset + step]
+            if rest:
+                choices, scores = self._score(rest, chunk)
+                # Ниже порога cdist возвращает 0 — заказ подходит, если совпали все слова
+                matched = (scores >= SCORE_CUTOFF).all(axis=0).nonzero()[0]
+                combined = (total[offset:offset + step] + scores.sum(axis=0)) / len(tokens)
+            else:
+                choices = [self.name_lower(i) for i in chunk]
+                matched = range(len(chunk))
+                combined = total[offset:offset + step] / len(tokens) if tokens else [100.0] * len(chunk)
+            yield chunk, choices, combined, matched, code
+
+    def search(self, query: str) -> List[str]:
+        """Возвращает заказы, в которых нашлись все токены запроса (partial_ratio >= 80)."""
+        if not query.split() or not len(self):
+            return []
+
+        started = time.perf_counter()
+        found = [self.name(chunk[j]) for chunk, _, _, matched, _ in self._chunks(query, None) for j in matched]
+        SEARCH_SECONDS.observe(time.perf_counter() - started)
+        return found
+
+    def top(self, query: str, limit: int, budget: Optional[float] = None) -> List[int]:
+        """Номера лучших limit заказов из search(), по убыванию средней оценки токенов.
+
+        При равной оценке выше заказы с точно совпавшим кодом, затем короткие
+        названия — в них запрос занимает большую часть. С budget (секунды)
+        кандидаты проверяются частями по BUDGET_CHUNK, и поиск останавливается,
+        когда время вышло: результат может быть неполным.
+        """
+        return self.rank(query, limit, budget)[0]
+
+    def rank(self, query: str, limit: int, budget: Optional[float] = None) -> Tuple[List[int], bool]:
+        """То же, что top(), и признак, что все кандидаты проверены (бюджет не кончился)."""
+        if not query.split() or not len(self):
+            return [], True
+
+        started = time.perf_counter()
+        best: List[tuple] = []
+        complete = True
+        for chunk, choices, combined, matched, code in self._chunks(query, budget):
+            best = heapq.nlargest(limit, itertools.chain(best, (
+                (combined[j], _exact_code(code, choices[j]), -len(choices[j]), -chunk[j]) for j in matched
+            )))
+            if budget is not None and time.perf_counter() - started >= budget:
+                complete = False
+                break
+        SEARCH_SECONDS.observe(time.perf_counter() - started)
+        return [-item[3] for item in best], complete
+
+
+def _exact_code(code: Optional[OrderCode], name: str) -> bool:
+    if code is None:
+        return False
+    parsed = parse_order_code(name)
+    return parsed is not None and parsed.number == code.number
+
+
+def _strings_section(strings: Iterable[str]):
+    offsets = array("I", [0])
+    blob = bytearray()
+    for s in strings:
+        blob += s.encode("utf-8")
+        offsets.append(len(blob))
+    return offsets, bytes(blob)
+
+
+def _postings_section(postings: Dict[int, List[int]]):
+    """Ключи по возрастанию, смещения и общий массив номеров заказов."""
+    keys = array("Q", sorted(postings))
+    offsets = array("I", [0])
+    values = array("I")
+    for key in keys:
+        values.extend(postings[key])
+        offsets.append(len(values))
+    return keys, offsets, values
+
+
+def _lookup(keys: Sequence[int], offsets: Sequence[int], values: Sequence[int], key: int) -> Sequence[int]:
+    pos = bisect_left(keys, key)
+    if pos == len(keys) or keys[pos] != key:
+        return ()
+    return values[offsets[pos]:offsets[pos + 1]]
+
+
+def _pad(data: bytes) -> bytes:
+    return data + b"\0" * (-len(data) % 8)
+
+
+def _fsync_dir(path: Path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        # Windows не открывает каталоги — там os.replace и так достаточно надёжен
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_index_file(index: OrderIndex, path: Path, version: int,
+                     updated_at: float = 0.0, full_synced_at: float = 0.0):
+    """Записывает индекс в файл для MappedOrderIndex.
+
+    Файл пишется рядом во временный, сбрасывается на диск (fsync) и подменяется
+    атомарно: при сбое посреди записи остаётся предыдущая версия.
+    """
+    ids_off, ids_blob = _strings_section(index.record_ids)
+    names_off, names_blob = _strings_section(index.names)
+    lower_off, lower_blob = _strings_section(index.names_lower)
+    keys, post_off, postings = _postings_section(
+        {_gram_key(gram): ids for gram, ids in index._postings.items()}
+    )
+    short = array("I", index._short)
+    code_keys, code_off, code_postings = _postings_section(index._codes)
+
+    header = _HEADER.pack(
+        INDEX_MAGIC, INDEX_FORMAT, version, updated_at, full_synced_at,
+        len(index), len(keys), len(short), len(ids_blob), len(names_blob), len(lower_blob), len(postings),
+        len(code_keys), len(code_postings)
+    )
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    path.parent.mkdir(exist_ok=True)
+    try:
+        with open(tmp_path, "wb") as f:
+            for part in (header, ids_off.tobytes(), ids_blob, names_off.tobytes(), names_blob,
+                         lower_off.tobytes(), lower_blob, keys.tobytes(), post_off.tobytes(),
+                         postings.tobytes(), short.tobytes(), code_keys.tobytes(), code_off.tobytes(),
+                         code_postings.tobytes()):
+                f.write(_pad(part))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    _fsync_dir(path.parent)
+
+
+class MappedOrderIndex(OrderIndex):
+    """Индекс заказов поверх файла write_index_file, отображённого в память.
+
+    Открытие не разбирает файл: страницы общие для всех процессов, читающих
+    его, а в памяти процесса декодируются только названия кандидатов, по
+    которым идёт нечёткий поиск.
+    """
+
+    def __init__(self, path: Path):
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._mmap)
+        # Все представления файла: close() освобождает их перед закрытием mmap
+        self._views = [view]
+        if len(view) < _HEADER.size:
+            raise ValueError(f"Файл индекса заказов повреждён: {path}")
+        (magic, fmt, version, updated_at, full_synced_at, n, g, s,
+         ids_len, names_len, lower_len, post_len, c, code_len) = _HEADER.unpack_from(view)
+        if magic != INDEX_MAGIC or fmt != INDEX_FORMAT:
+            raise ValueError(f"Неизвестный формат индекса заказов: {path}")
+        self.version = version
+        self.updated_at = updated_at
+        self.full_synced_at = full_synced_at
+        self._count = n
+        self._matches = _token_cache()
+
+        pos = _HEADER.size + (-_HEADER.size % 8)
+
+        def take(size: int, fmt: Optional[str] = None):
+            nonlocal pos
+            if pos + size > len(view):
+                raise ValueError(f"Файл индекса заказов обрезан: {path}")
+            part = view[pos:pos + size]
+            pos += size + (-size % 8)
+            part = part.cast(fmt) if fmt else part
+            self._views.append(part)
+            return part
+
+        self._ids_off = take(4 * (n + 1), "I")
+        self._ids_blob = take(ids_len)
+        self._names_off = take(4 * (n + 1), "I")
+        self._names_blob = take(names_len)
+        self._lower_off = take(4 * (n + 1), "I")
+        self._lower_blob = take(lower_len)
+        self._keys = take(8 * g, "Q")
+        self._post_off = take(4 * (g + 1), "I")
+        self._postings_view = take(4 * post_len, "I")
+        self._short_view = take(4 * s, "I")
+        self._code_keys = take(8 * c, "Q")
+        self._code_off = take(4 * (c + 1), "I")
+        self._code_view = take(4 * code_len, "I")
+
+    @property
+    def names(self) -> List[str]:
+        return [self.name(i) for i in range(self._count)]
+
+    @property
+    def record_ids(self) -> List[str]:
+        return [self.record_id(i) for i in range(self._count)]
+
+    def __len__(self) -> int:
+        return self._count
+
+    def close(self):
+        """Снимает отображение файла. На Windows отображённый файл нельзя
+        заменить (os.replace), поэтому индекс закрывается перед записью снимка."""
+        for view in reversed(self._views):
+            view.release()
+        self._views = []
+        self._count = 0
+        self._mmap.close()
+
+    def name(self, i: int) -> str:
+        return bytes(self._names_blob[self._names_off[i]:self._names_off[i + 1]]).decode("utf-8")
+
+    def record_id(self, i: int) -> str:
+        return bytes(self._ids_blob[self._ids_off[i]:self._ids_off[i + 1]]).decode("utf-8")
+
+    def name_lower(self, i: int) -> str:
+        return bytes(self._lower_blob[self._lower_off[i]:self._lower_off[i + 1]]).decode("utf-8")
+
+    def _gram_postings(self, gram: str) -> Sequence[int]:
+        return _lookup(self._keys, self._post_off, self._postings_view, _gram_key(gram))
+
+    def _short_ids(self) -> Sequence[int]:
+        return self._short_view
+
+    def _code_postings(self, key: int) -> Sequence[int]:
+        return _lookup(self._code_keys, self._code_off, self._code_view, key)
@@ -0,0 +1,322 @@
+# bot/outbox.py
+import asyncio
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, NamedTuple, Optional
+from .airtable_client import AirtableClient, AirtableError, MAX_RECORDS_PER_REQUEST
+from .attachments import AttachmentUploader
+from .config import OUTBOX_BATCH_DELAY, OUTBOX_MAX_RPS, PAYMENT_DEDUP_WINDOW
+from .metrics import DUPLICATES_SUPPRESSED
+
+OUTBOX_FILE = Path(__file__).parent.parent / "cache" / "outbox.sqlite3"
+# Пауза перед повтором, если Airtable недоступен (растёт до максимума)
+RETRY_DELAY = 5
+MAX_RETRY_DELAY = 300
+# Как часто проверять очередь без сигнала: записи могут добавлять другие процессы бота
+POLL_INTERVAL = 5
+
+logger = logging.getLogger(__name__)
+
+class OutboxEntry(NamedTuple):
+    """Запись очереди; created=False — такая оплата уже была, возвращена прежняя запись."""
+    id: int
+    created: bool
+    status: str
+    record_id: Optional[str]
+
+
+def payment_key(user_id: int, dialog_id: Optional[str]) -> Optional[str]:
+    """Ключ идемпотентности оплаты: пользователь и метка диалога, выданная при его начале.
+
+    Двойное нажатие кнопки или повтор сохранения в том же диалоге дают тот же
+    ключ, а две настоящие оплаты с одинаковыми полями — разные. Повторную
+    доставку обновлений отсеивает DuplicateUpdateMiddleware. Диалог, начатый
+    до появления меток, ключа не получает.
+    """
+    if not dialog_id:
+        return None
+    return hashlib.sha256(f"{user_id}:{dialog_id}".encode()).hexdigest()
+
+
+# notify(chat_id, record_id, error) — сообщает пользователю, чем закончилась отправка
+Notifier = Callable[[int, Optional[str], Optional[str]], Awaitable[None]]
+
+
+class PaymentOutbox:
+    """Локальная очередь оплат: запись считается принятой, как только она
+    сохранена в SQLite, а в Airtable уходит пачками в фоне. Вложения
+    загружаются в уже созданную запись отдельно, через AttachmentUploader."""
+
+    def __init__(self, client: AirtableClient, uploader: Optional[AttachmentUploader] = None,
+                 path: Path = OUTBOX_FILE):
+        self.client = client
+        self.uploader = uploader
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._wakeup = asyncio.Event()
+        self._writer_task: Optional[asyncio.Task] = None
+        self._notify: Optional[Notifier] = None
+
+    # === SQLite (вызывается в отдельном потоке) ===
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.path.parent.mkdir(exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=FULL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    fields TEXT NOT NULL,
+                    chat_id INTEGER,
+                    created_at REAL NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    record_id TEXT,
+                    last_error TEXT
+                )
+            """)
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(outbox)")}
+            if "attachments" not in columns:
+                # Вложения и статус их загрузки: pending / done / failed
+                conn.execute("ALTER TABLE outbox ADD COLUMN attachments TEXT")
+                conn.execute("ALTER TABLE outbox ADD COLUMN attachments_status TEXT")
+            if "idempotency_key" not in columns:
+                conn.execute("ALTER TABLE outbox ADD COLUMN idempotency_key TEXT")
+            conn.execute("CREATE INDEX IF NOT EXISTS outbox_status ON outbox (status, id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS outbox_idempotency ON outbox (idempotency_key, created_at)")
+            self._conn = conn
+        return self._conn
+
+    def _insert(self, fields: Dict[str, Any], chat_id: Optional[int],
+                attachments: Optional[List[Dict[str, Any]]], idempotency_key: Optional[str]) -> OutboxEntry:
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            # IMMEDIATE: проверка ключа и вставка атомарны и между процессами бота
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if idempotency_key is not None:
+                    # Отклонённая Airtable запись не считается: оплату можно сохранить заново
+                    row = conn.execute(
+                        "SELECT id, status, record_id FROM outbox "
+                        "WHERE idempotency_key = ? AND created_at >= ? AND status != 'failed' "
+                        "ORDER BY id DESC LIMIT 1",
+                        (idempotency_key, now - PAYMENT_DEDUP_WINDOW)
+                    ).fetchone()
+                    if row is not None:
+                        conn.execute("COMMIT")
+                        return OutboxEntry(row[0], False, row[1], row[2])
+                cursor = conn.execute(
+                    "INSERT INTO outbox (fields, chat_id, created_at, attachments, attachments_status, idempotency_key) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        json.dumps(fields, ensure_ascii=False),
+                        chat_id,
+                        now,
+                        json.dumps(attachments, ensure_ascii=False) if attachments else None,
+                        "pending" if attachments else None,
+                        idempotency_key
+                    )
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            return OutboxEntry(cursor.lastrowid, True, "pending", None)
+
+    def _pending(self, limit: int) -> List[tuple]:
+        with self._lock:
+            return self._connect().execute(
+                "SELECT id, fields, chat_id, attachments FROM outbox WHERE status = 'pending' ORDER BY id LIMIT ?",
+                (limit,)
+            ).fetchall()
+
+    def _pending_attachments(self) -> List[tuple]:
+        with self._lock:
+            return self._connect().execute(
+                "SELECT id, record_id, attachments FROM outbox "
+                "WHERE status = 'sent' AND attachments_status = 'pending' AND record_id IS NOT NULL"
+            ).fetchall()
+
+    def _set_attachments_status(self, entry_id: int, status: str, error: Optional[str]) -> Optional[tuple]:
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "UPDATE outbox SET attachments_status = ?, last_error = COALESCE(?, last_error) WHERE id = ?",
+                (status, error, entry_id)
+            )
+            return conn.execute("SELECT chat_id, record_id FROM outbox WHERE id = ?", (entry_id,)).fetchone()
+
+    def _set_file_uploaded(self, entry_id: int, index: int):
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT attachments FROM outbox WHERE id = ?", (entry_id,)).fetchone()
+                if row is not None and row[0]:
+                    attachments = json.loads(row[0])
+                    attachments[index]["uploaded"] = True
+                    conn.execute(
+                        "UPDATE outbox SET attachments = ? WHERE id = ?",
+                        (json.dumps(attachments, ensure_ascii=False), entry_id)
+                    )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+    def _mark_sent(self, ids: List[int], record_ids: List[Optional[str]]):
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN")
+            conn.executemany(
+                "UPDATE outbox SET status = 'sent', record_id = ?, attempts = attempts + 1 WHERE id = ?",
+                list(zip(record_ids, ids))
+            )
+            conn.execute("COMMIT")
+
+    def _mark_failed(self, ids: List[int], error: str, permanent: bool):
+        status = "failed" if permanent else "pending"
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN")
+            conn.executemany(
+                "UPDATE outbox SET status = ?, last_error = ?, attempts = attempts + 1 WHERE id = ?",
+                [(status, error, entry_id) for entry_id in ids]
+            )
+            conn.execute("COMMIT")
+
+    def _close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    # === Публичный интерфейс ===
+    async def put(self, fields: Dict[str, Any], chat_id: Optional[int] = None,
+                  attachments: Optional[List[Dict[str, Any]]] = None,
+                  idempotency_key: Optional[str] = None) -> OutboxEntry:
+        """Сохраняет запись на диск и будит фоновую отправку.
+
+        Если за последние PAYMENT_DEDUP_WINDOW секунд уже сохранена запись
+        с тем же idempotency_key, новая не создаётся — возвращается прежняя
+        (с record_id, если она уже в Airtable).
+        """
+        entry = await asyncio.to_thread(self._insert, fields, chat_id, attachments, idempotency_key)
+        if not entry.created:
+            DUPLICATES_SUPPRESSED.inc("payment")
+            logger.info(f"Повтор оплаты: запись очереди #{entry.id} уже есть ({entry.record_id or entry.status})")
+            return entry
+        self._wakeup.set()
+        return entry
+
+    async def pending_count(self) -> int:
+        def count():
+            with self._lock:
+                return self._connect().execute(
+                    "SELECT COUNT(*) FROM outbox WHERE status = 'pending'"
+                ).fetchone()[0]
+        return await asyncio.to_thread(count)
+
+    def start(self, notify: Optional[Notifier] = None):
+        """Запускает фоновую отправку; неотправленные до перезапуска записи уйдут первыми."""
+        self._notify = notify
+        if self._writer_task is None or self._writer_task.done():
+            self._wakeup.set()
+            self._writer_task = asyncio.create_task(self._run())
+
+    async def _resume_attachments(self):
+        for entry_id, record_id, attachments in await asyncio.to_thread(self._pending_attachments):
+            self.uploader.submit(entry_id, record_id, json.loads(attachments))
+
+    async def attachment_uploaded(self, entry_id: int, index: int):
+        """Отмечает загруженный файл: после перезапуска он не загрузится повторно."""
+        await asyncio.to_thread(self._set_file_uploaded, entry_id, index)
+
+    async def attachments_done(self, entry_id: int, error: Optional[str]):
+        status = "failed" if error else "done"
+        row = await asyncio.to_thread(self._set_attachments_status, entry_id, status, error)
+        if error and row is not None:
+            await self._report(row[0], row[1], f"Вложение не загружено: {error}")
+
+    async def stop(self):
+        if self._writer_task is not None and not self._writer_task.done():
+            self._writer_task.cancel()
+            try:
+                await self._writer_task
+            except asyncio.CancelledError:
+                pass
+        self._writer_task = None
+        await asyncio.to_thread(self._close)
+
+    # === Фоновая отправка ===
+    async def _run(self):
+        if self.uploader is not None:
+            # Докачиваем вложения записей, созданных до перезапуска
+            await self._resume_attachments()
+        retry_delay = RETRY_DELAY
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            # Даём накопиться записям, чтобы отправить их одной пачкой
+            await asyncio.sleep(OUTBOX_BATCH_DELAY)
+            while True:
+                rows = await asyncio.to_thread(self._pending, MAX_RECORDS_PER_REQUEST)
+                if not rows:
+                    retry_delay = RETRY_DELAY
+                    break
+                started = time.monotonic()
+                if not await self._flush(rows):
+                    logger.warning(f"Airtable недоступен, повтор отправки через {retry_delay} сек")
+                    await asyncio.sleep(retry_delay)
+                    retry_delay = min(retry_delay * 2, MAX_RETRY_DELAY)
+                    continue
+                retry_delay = RETRY_DELAY
+                # Не превышаем OUTBOX_MAX_RPS запросов в секунду
+                await asyncio.sleep(max(0.0, 1 / OUTBOX_MAX_RPS - (time.monotonic() - started)))
+
+    async def _flush(self, rows: List[tuple]) -> bool:
+        """Отправляет пачку; False — временная ошибка, пачку нужно повторить позже."""
+        ids = [row[0] for row in rows]
+        try:
+            response = await self.client.create_records([json.loads(row[1]) for row in rows])
+        except AirtableError as e:
+            if not e.is_permanent:
+                await asyncio.to_thread(self._mark_failed, ids, str(e), False)
+                return False
+            if len(rows) > 1:
+                # Одна некорректная запись отклоняет всю пачку — отправляем по одной
+                results = [await self._flush([row]) for row in rows]
+                return all(results)
+            logger.error(f"Airtable отклонил запись из очереди #{ids[0]}: {e}")
+            await asyncio.to_thread(self._mark_failed, ids, str(e), True)
+            await self._report(rows[0][2], None, str(e))
+            return True
+
+        record_ids = [record.get("id") for record in response.get("records", [])]
+        record_ids += [None] * (len(ids) - len(record_ids))
+        await asyncio.to_thread(self._mark_sent, ids, record_ids)
+        logger.info(f"Отправлено в Airtable записей из очереди: {len(ids)}")
+        for row, record_id in zip(rows, record_ids):
+            if row[3] and record_id and self.uploader is not None:
+                self.uploader.submit(row[0], record_id, json.loads(row[3]))
+            await self._report(row[2], record_id, None)
+        return True
+
+    async def _report(self, chat_id: Optional[int], record_id: Optional[str], error: Optional[str]):
+        if self._notify is None or chat_id is None:
+            return
+        try:
+            await self._notify(chat_id, record_id, error)
+        except Exception as e:
+            logger.warning(f"Не удалось уведомить пользователя {chat_id}: {e}")
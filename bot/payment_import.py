@@ -0,0 +1,410 @@
+# bot/payment_import.py
+import asyncio
+import csv
+import hashlib
+import io
+import json
+import logging
+import os
+import re
+from datetime import date
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Sequence, Set, Tuple
+from .airtable_client import AirtableClient, AirtableError, MAX_RECORDS_PER_REQUEST
+from .cache_manager import OrdersCache
+from .config import IMPORT_CONCURRENCY, IMPORT_MAX_RPS
+from .order_codes import find_order_codes, parse_order_code
+from .rate_limiter import RateLimiter, PRIORITY_BACKGROUND
+
+# Журналы импорта: по одному на файл выписки (по хэшу содержимого)
+IMPORT_DIR = Path(__file__).parent.parent / "cache" / "imports"
+# Сколько лучших заказов брать из поиска — столько же, сколько предлагает process_order
+IMPORT_SEARCH_LIMIT = 50
+# Сколько вариантов показывать в отчёте для строк, требующих проверки
+IMPORT_SUGGESTIONS = 3
+# В скольких первых строках искать заголовок (в выписках сверху бывает шапка банка)
+HEADER_SCAN_ROWS = 20
+# Через сколько строк отдавать управление циклу событий, чтобы не задерживать хендлеры
+YIELD_EVERY = 50
+
+# Первое число в ячейке суммы: разряды через пробел (в т.ч. неразрывный) или апостроф
+# только группами по три цифры, дальше — части через точку или запятую
+AMOUNT_RE = re.compile(r"-?\d+(?:[\s\u00a0\u202f']\d{3}(?!\d))*(?:[.,]\d+)*")
+
+# Названия колонок выписки (без регистра) → поле строки импорта
+COLUMN_ALIASES = {
+    "amount": {"сумма", "сумма платежа", "сумма операции", "приход", "поступление", "кредит", "amount"},
+    "order": {"заказ", "назначение", "назначение платежа", "order", "purpose"},
+    "payer": {"плательщик", "контрагент", "отправитель", "payer"},
+    "note": {"примечание", "комментарий", "note", "comment"},
+    "date": {"дата", "дата операции", "дата платежа", "date"}
+}
+
+logger = logging.getLogger(__name__)
+
+
+class ImportFileError(ValueError):
+    """Файл выписки не удалось разобрать (формат, кодировка, нет нужных колонок)."""
+
+
+class ImportRow(NamedTuple):
+    number: int
+    amount: Optional[float]
+    order: str
+    payer: str
+    note: str
+    date: str
+
+
+class FlaggedRow(NamedTuple):
+    number: int
+    amount: Optional[float]
+    order: str
+    reason: str
+    suggestions: List[str]
+
+
+class ImportReport:
+    """Итог импорта: сколько записано, сколько уже было записано раньше и что проверить вручную."""
+
+    def __init__(self, source: str, dry_run: bool = False):
+        self.source = source
+        self.dry_run = dry_run
+        self.total = 0
+        self.written = 0
+        self.resumed = 0
+        self.flagged: List[FlaggedRow] = []
+        self.failed: List[FlaggedRow] = []
+
+    def flag(self, row: ImportRow, reason: str, suggestions: Sequence[str] = ()):
+        self.flagged.append(FlaggedRow(row.number, row.amount, row.order, reason, list(suggestions)))
+
+    def summary(self) -> str:
+        lines = [
+            f"Строк с оплатами: {self.total}",
+            f"{'Будет записано' if self.dry_run else 'Записано'}: {self.written}",
+            f"Нужна проверка: {len(self.flagged)}",
+            f"Не записано из-за ошибок Airtable: {len(self.failed)}"
+        ]
+        if self.resumed:
+            lines.insert(2, f"Уже записаны при прошлом запуске: {self.resumed}")
+        return "\n".join(lines)
+
+    def flagged_csv(self) -> bytes:
+        """Строки для ручной проверки (CSV с разделителем «;», открывается в Excel)."""
+        out = io.StringIO()
+        writer = csv.writer(out, delimiter=";")
+        writer.writerow(["Строка", "Сумма", "Заказ", "Причина", "Варианты"])
+        for row in sorted(self.flagged + self.failed):
+            amount = "" if row.amount is None else f"{row.amount:g}".replace(".", ",")
+            writer.writerow([row.number, amount, row.order, row.reason, " | ".join(row.suggestions)])
+        return out.getvalue().encode("utf-8-sig")
+
+
+# === Разбор файла ===
+def _cell_text(value: Any) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, date):
+        return value.strftime("%d.%m.%Y")
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value).strip()
+
+
+def parse_amount(value: Any) -> Optional[float]:
+    """Сумма из выписки: «1 234,56 руб.», «2.500,00», «1234.56 ₽» или число из XLSX; None — не сумма.
+
+    Берётся первое число в тексте (разряды через пробел, точку или запятую);
+    валюта и прочий текст отбрасываются.
+    """
+    if isinstance(value, (int, float)):
+        amount = float(value)
+    else:
+        match = AMOUNT_RE.search(str(value or ""))
+        if match is None:
+            return None
+        text = re.sub(r"[\s']", "", match.group())
+        separators = [i for i, ch in enumerate(text) if ch in ",."]
+        if separators:
+            last = separators[-1]
+            digits_after = len(text) - last - 1
+            # Десятичный знак — последний разделитель, если он встречается один раз
+            # (или после него другой знак) и за ним не ровно три цифры разряда:
+            # «1,5» и «2.500,00» — дробные, «1,234» и «1.234.567» — целые
+            single = text.count(text[last]) == 1
+            mixed = len({text[i] for i in separators}) > 1
+            if mixed or (single and digits_after != 3):
+                text = text[:last].replace(",", "").replace(".", "") + "." + text[last + 1:]
+            else:
+                text = text.replace(",", "").replace(".", "")
+        amount = float(text)
+    # Как и в диалоге, принимаются только положительные суммы
+    return amount if amount > 0 else None
+
+
+def _decode(data: bytes) -> str:
+    for encoding in ("utf-8-sig", "cp1251"):
+        try:
+            return data.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+    raise ImportFileError("Не удалось определить кодировку CSV (ожидается UTF-8 или Windows-1251)")
+
+
+class _SemicolonDialect(csv.excel):
+    delimiter = ";"
+
+
+def _csv_rows(data: bytes) -> Iterator[List[Any]]:
+    text = _decode(data)
+    try:
+        dialect = csv.Sniffer().sniff(text[:4096], delimiters=";,\t")
+    except csv.Error:
+        # Разделитель не угадан — в русских выписках это чаще всего «;»
+        dialect = _SemicolonDialect
+    yield from csv.reader(io.StringIO(text), dialect)
+
+
+def _xlsx_rows(data: bytes) -> Iterator[List[Any]]:
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        raise ImportFileError("Для XLSX нужен пакет openpyxl (pip install openpyxl) — или пришлите CSV")
+    workbook = load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+    try:
+        for row in workbook.active.iter_rows(values_only=True):
+            yield list(row)
+    finally:
+        workbook.close()
+
+
+def _find_columns(header: List[Any]) -> Dict[str, int]:
+    columns = {}
+    for position, title in enumerate(header):
+        title = _cell_text(title).lower()
+        for field, aliases in COLUMN_ALIASES.items():
+            if title in aliases and field not in columns:
+                columns[field] = position
+    return columns
+
+
+def read_rows(data: bytes, filename: str) -> List[ImportRow]:
+    """Строки выписки с оплатами; номер строки — как в файле (с 1)."""
+    if filename.lower().endswith((".xlsx", ".xlsm")):
+        raw_rows = _xlsx_rows(data)
+    elif filename.lower().endswith((".csv", ".txt")):
+        raw_rows = _csv_rows(data)
+    else:
+        raise ImportFileError("Поддерживаются файлы CSV и XLSX")
+
+    columns = None
+    rows = []
+    for number, raw in enumerate(raw_rows, start=1):
+        if columns is None:
+            found = _find_columns(raw)
+            if "amount" in found and "order" in found:
+                columns = found
+            elif number >= HEADER_SCAN_ROWS:
+                break
+            continue
+
+        def cell(field: str) -> Any:
+            position = columns.get(field)
+            return raw[position] if position is not None and position < len(raw) else None
+
+        if not any(_cell_text(value) for value in raw):
+            continue
+        rows.append(ImportRow(
+            number=number,
+            amount=parse_amount(cell("amount")),
+            order=_cell_text(cell("order")),
+            payer=_cell_text(cell("payer")),
+            note=_cell_text(cell("note")),
+            date=_cell_text(cell("date"))
+        ))
+    if columns is None:
+        raise ImportFileError("Не найдены колонки «Сумма» и «Заказ» (или «Назначение платежа»)")
+    return rows
+
+
+def file_digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+# === Подбор заказа ===
+class OrderMatch(NamedTuple):
+    order: Optional[str]
+    reason: str
+    suggestions: List[str]
+
+
+async def match_order(orders: OrdersCache, text: str) -> OrderMatch:
+    """Заказ для строки выписки — тем же поиском, что и в диалоге (OrdersCache.search).
+
+    Строка принимается сама, только если в тексте есть код заказа и ровно один
+    заказ совпал с ним полностью; иначе — варианты для ручной проверки.
+    """
+    if not text:
+        return OrderMatch(None, "Не указан заказ", [])
+    codes = find_order_codes(text)
+    if not codes:
+        found = await orders.search(text, IMPORT_SEARCH_LIMIT)
+        return OrderMatch(None, "Нет кода заказа", [name for _, name in found[:IMPORT_SUGGESTIONS]])
+
+    exact: Dict[str, str] = {}
+    suggestions: List[str] = []
+    for code in codes:
+        for record_id, name in await orders.search(code.text, IMPORT_SEARCH_LIMIT):
+            parsed = parse_order_code(name)
+            if parsed is not None and parsed.text == code.text:
+                exact[record_id] = name
+            if name not in suggestions:
+                suggestions.append(name)
+    if len(exact) == 1:
+        return OrderMatch(next(iter(exact.values())), "", [])
+    if exact:
+        return OrderMatch(None, "Код подходит к нескольким заказам", list(exact.values())[:IMPORT_SUGGESTIONS])
+    return OrderMatch(None, "Заказ с таким кодом не найден", suggestions[:IMPORT_SUGGESTIONS])
+
+
+# === Журнал импорта ===
+class ImportCheckpoint:
+    """Журнал импорта одного файла (JSON lines, дописывается с fsync).
+
+    Перед отправкой пачки пишется {"sending": [строки]}, после ответа Airtable —
+    {"sent": [строки], "records": [ID]} или {"failed": [строки]}. При повторном
+    запуске отправленные строки пропускаются, неудавшиеся отправляются снова, а
+    строки пачки без ответа (процесс прервали посреди запроса) не отправляются
+    повторно — они могли уже попасть в Airtable и уходят на ручную проверку.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+
+    def load(self) -> Tuple[Dict[int, str], Set[int]]:
+        """Отправленные строки (номер → ID записи) и строки с неизвестным исходом."""
+        sent: Dict[int, str] = {}
+        uncertain: Set[int] = set()
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return sent, uncertain
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # Последняя строка могла не дописаться при сбое
+                continue
+            if "sending" in entry:
+                uncertain.update(entry["sending"])
+            elif "sent" in entry:
+                records = entry.get("records") or []
+                for k, number in enumerate(entry["sent"]):
+                    sent[number] = records[k] if k < len(records) and records[k] else ""
+                uncertain.difference_update(entry["sent"])
+            elif "failed" in entry:
+                uncertain.difference_update(entry["failed"])
+        return sent, uncertain - sent.keys()
+
+    def append(self, entry: Dict[str, Any]):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+
+# === Импорт ===
+class PaymentImport:
+    """Импорт оплат из выписки: подбор заказов и запись в Airtable пачками по 10.
+
+    Пачки отправляются параллельно (не больше IMPORT_CONCURRENCY), не чаще
+    IMPORT_MAX_RPS запросов в секунду и с фоновым приоритетом общего лимитера,
+    так что записи из диалогов идут впереди.
+    """
+
+    def __init__(self, client: AirtableClient, orders: OrdersCache, data: bytes, filename: str,
+                 sender: str, dry_run: bool = False, checkpoint_dir: Path = IMPORT_DIR):
+        self.client = client
+        self.orders = orders
+        self.data = data
+        self.filename = filename
+        self.sender = sender
+        self.dry_run = dry_run
+        self.checkpoint = ImportCheckpoint(checkpoint_dir / f"{file_digest(data)[:16]}.jsonl")
+        self.report = ImportReport(filename, dry_run)
+        self._slots = asyncio.Semaphore(IMPORT_CONCURRENCY)
+        self._limiter = RateLimiter(IMPORT_MAX_RPS, 1)
+
+    def _fields(self, row: ImportRow, order: str) -> Dict[str, Any]:
+        # Те же поля, что и у записи из диалога; плательщик и дата — в примечании
+        fields: Dict[str, Any] = {"Отправитель": self.sender, "Сумма": row.amount, "Заказ": order}
+        note = "; ".join(part for part in (row.date, row.payer, row.note) if part)
+        if note:
+            fields["Примечание"] = note
+        return fields
+
+    async def run(self) -> ImportReport:
+        rows = await asyncio.to_thread(read_rows, self.data, self.filename)
+        sent, uncertain = await asyncio.to_thread(self.checkpoint.load)
+        self.report.total = len(rows)
+        logger.info(f"Импорт {self.filename}: строк {len(rows)}, уже отправлено {len(sent)}")
+
+        batch: List[Tuple[ImportRow, Dict[str, Any]]] = []
+        tasks: List[asyncio.Task] = []
+        for i, row in enumerate(rows):
+            if i % YIELD_EVERY == YIELD_EVERY - 1:
+                await asyncio.sleep(0)
+            if row.number in sent:
+                self.report.resumed += 1
+                continue
+            if row.number in uncertain:
+                self.report.flag(row, "Импорт прерывался при отправке — проверьте, есть ли запись в Airtable")
+                continue
+            if row.amount is None:
+                self.report.flag(row, "Не распознана сумма")
+                continue
+            match = await match_order(self.orders, row.order)
+            if match.order is None:
+                self.report.flag(row, match.reason, match.suggestions)
+                continue
+            if self.dry_run:
+                self.report.written += 1
+                continue
+            batch.append((row, self._fields(row, match.order)))
+            if len(batch) == MAX_RECORDS_PER_REQUEST:
+                tasks.append(asyncio.create_task(self._send(batch)))
+                batch = []
+        if batch:
+            tasks.append(asyncio.create_task(self._send(batch)))
+        await asyncio.gather(*tasks)
+        logger.info(f"Импорт {self.filename} завершён. {self.report.summary()}".replace("\n", ", "))
+        return self.report
+
+    async def _send(self, batch: List[Tuple[ImportRow, Dict[str, Any]]]):
+        numbers = [row.number for row, _ in batch]
+        async with self._slots:
+            await self._limiter.acquire()
+            await asyncio.to_thread(self.checkpoint.append, {"sending": numbers})
+            try:
+                response = await self.client.create_records(
+                    [fields for _, fields in batch], priority=PRIORITY_BACKGROUND
+                )
+            except AirtableError as e:
+                error = e
+            else:
+                record_ids = [record.get("id") for record in response.get("records", [])]
+                await asyncio.to_thread(self.checkpoint.append, {"sent": numbers, "records": record_ids})
+                self.report.written += len(batch)
+                return
+
+        await asyncio.to_thread(self.checkpoint.append, {"failed": numbers, "error": str(error)})
+        if error.is_permanent and len(batch) > 1:
+            # Одна некорректная запись отклоняет всю пачку — отправляем по одной
+            await asyncio.gather(*(self._send([item]) for item in batch))
+            return
+        logger.error(f"Импорт {self.filename}: строки {numbers} не записаны: {error}")
+        for row, _ in batch:
+            self.report.failed.append(FlaggedRow(row.number, row.amount, row.order, str(error), []))
@@ -0,0 +1,256 @@
+# bot/payments_replica.py
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+from datetime import date, datetime
+from pathlib import Path
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+from .airtable_client import AirtableClient
+from .config import PAYMENTS_SYNC_INTERVAL, PAYMENTS_FULL_SYNC_INTERVAL
+from .metrics import PAYMENTS_REPLICA_EVENTS
+from .order_codes import find_order_codes, parse_order_code
+from .sync import BackgroundSync, SYNC_OVERLAP, delta_since
+
+REPLICA_FILE = Path(__file__).parent.parent / "cache" / "payments.sqlite3"
+
+logger = logging.getLogger(__name__)
+
+
+class Payment(NamedTuple):
+    record_id: str
+    created_at: float
+    sender: str
+    amount: Optional[float]
+    order: str
+    note: str
+
+
+class OrderSummary(NamedTuple):
+    count: int
+    total: float
+    first_at: Optional[float]
+    last_at: Optional[float]
+
+
+def _parse_time(value: Optional[str]) -> float:
+    """createdTime Airtable ("2024-03-01T09:15:00.000Z") → unix time."""
+    if not value:
+        return time.time()
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+
+
+def _amount(value: Any) -> Optional[float]:
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(str(value).replace(" ", "").replace(",", "."))
+    except ValueError:
+        return None
+
+
+def _text(value: Any) -> str:
+    if isinstance(value, list):
+        # Поле-ссылка или множественный выбор
+        return ", ".join(str(v) for v in value)
+    return str(value).strip() if value is not None else ""
+
+
+def _row(record: Dict[str, Any]) -> tuple:
+    fields = record.get("fields", {})
+    created_at = _parse_time(record.get("createdTime"))
+    order = _text(fields.get("Заказ"))
+    code = parse_order_code(order)
+    return (
+        record["id"],
+        created_at,
+        # День — по местному времени бота: так его видят пользователи
+        date.fromtimestamp(created_at).isoformat(),
+        _text(fields.get("Отправитель")),
+        _amount(fields.get("Сумма")),
+        order,
+        order.casefold(),
+        code.text if code is not None else None,
+        _text(fields.get("Примечание"))
+    )
+
+
+class PaymentsReplica:
+    """Локальная копия таблицы оплат для команд просмотра (/recent, /summary, /daily).
+
+    Команды читают только SQLite и не обращаются к Airtable. Реплика
+    пополняется сразу после создания записей (write-through из
+    AirtableClient.create_records) и догоняет правки из интерфейса Airtable
+    дельта-синхронизацией; полная выгрузка раз в PAYMENTS_FULL_SYNC_INTERVAL
+    убирает удалённые записи. Файл общий для всех процессов бота,
+    синхронизирует его только основной.
+    """
+
+    def __init__(self, client: AirtableClient, path: Path = REPLICA_FILE):
+        self.client = client
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._syncer = BackgroundSync(self._sync)
+
+    # === SQLite (вызывается в отдельном потоке) ===
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.path.parent.mkdir(exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS payments (
+                    id TEXT PRIMARY KEY,
+                    created_at REAL NOT NULL,
+                    day TEXT NOT NULL,
+                    sender TEXT NOT NULL,
+                    amount REAL,
+                    order_name TEXT NOT NULL,
+                    order_key TEXT NOT NULL,
+                    order_code TEXT,
+                    note TEXT NOT NULL
+                )
+            """)
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS payments_created ON payments (created_at)")
+            # Итоги по заказу: по коду (АОС-0125) или по названию без учёта регистра.
+            # order_key — casefold() названия: NOCASE в SQLite не знает кириллицы
+            conn.execute("CREATE INDEX IF NOT EXISTS payments_order_code ON payments (order_code, amount)")
+            conn.execute("CREATE INDEX IF NOT EXISTS payments_order_key ON payments (order_key, amount)")
+            # Итоги за день по отправителям считаются по одному индексу, без чтения таблицы
+            conn.execute("CREATE INDEX IF NOT EXISTS payments_day_sender ON payments (day, sender, amount)")
+            self._conn = conn
+        return self._conn
+
+    def _meta(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(self._connect().execute("SELECT key, value FROM meta").fetchall())
+
+    def _upsert(self, records: List[Dict[str, Any]], meta: Optional[Dict[str, float]] = None,
+                replace_before: Optional[float] = None):
+        """Добавляет и обновляет записи; с replace_before — удаляет созданные раньше
+        этого момента, но отсутствующие в records (полная выгрузка)."""
+        rows = [_row(record) for record in records if record.get("id")]
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if replace_before is not None:
+                    # Записи, созданные во время выгрузки (write-through), не трогаем
+                    fetched = {row[0] for row in rows}
+                    stale = [
+                        (record_id,) for (record_id,) in conn.execute(
+                            "SELECT id FROM payments WHERE created_at < ?", (replace_before,)
+                        ) if record_id not in fetched
+                    ]
+                    conn.executemany("DELETE FROM payments WHERE id = ?", stale)
+                conn.executemany(
+                    "INSERT OR REPLACE INTO payments "
+                    "(id, created_at, day, sender, amount, order_name, order_key, order_code, note) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    rows
+                )
+                if meta:
+                    conn.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", meta.items())
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+    def _query(self, sql: str, params: tuple = ()) -> List[tuple]:
+        with self._lock:
+            return self._connect().execute(sql, params).fetchall()
+
+    def _close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    # === Чтение ===
+    async def recent(self, limit: int) -> List[Payment]:
+        """Последние limit оплат, новые первыми."""
+        rows = await asyncio.to_thread(
+            self._query,
+            "SELECT id, created_at, sender, amount, order_name, note FROM payments "
+            "ORDER BY created_at DESC LIMIT ?",
+            (limit,)
+        )
+        return [Payment(*row) for row in rows]
+
+    async def order_summary(self, order: str) -> OrderSummary:
+        """Число оплат и сумма по заказу.
+
+        Если во вводе есть код заказа (АОС-0125), учитываются все записи с этим
+        кодом в начале названия; иначе — записи с точно таким названием (без учёта регистра).
+        """
+        codes = find_order_codes(order)
+        if codes:
+            where, param = "order_code = ?", codes[0].text
+        else:
+            where, param = "order_key = ?", order.strip().casefold()
+        rows = await asyncio.to_thread(
+            self._query,
+            f"SELECT COUNT(*), TOTAL(amount), MIN(created_at), MAX(created_at) FROM payments WHERE {where}",
+            (param,)
+        )
+        return OrderSummary(*rows[0])
+
+    async def daily_totals(self, day: date) -> List[Tuple[str, int, float]]:
+        """Итоги дня по отправителям: [(отправитель, число оплат, сумма)], больше — выше."""
+        return await asyncio.to_thread(
+            self._query,
+            "SELECT sender, COUNT(*), TOTAL(amount) FROM payments WHERE day = ? "
+            "GROUP BY sender ORDER BY TOTAL(amount) DESC",
+            (day.isoformat(),)
+        )
+
+    async def count(self) -> int:
+        rows = await asyncio.to_thread(self._query, "SELECT COUNT(*) FROM payments")
+        return rows[0][0]
+
+    # === Запись ===
+    async def add_created(self, records: List[Dict[str, Any]]):
+        """Write-through: записи, только что созданные в Airtable."""
+        await asyncio.to_thread(self._upsert, records)
+        PAYMENTS_REPLICA_EVENTS.inc("write_through", amount=len(records))
+
+    async def _sync(self):
+        started_at = time.time()
+        meta = await asyncio.to_thread(self._meta)
+        synced_at = meta.get("synced_at")
+        full = synced_at is None or started_at - meta.get("full_synced_at", 0) >= PAYMENTS_FULL_SYNC_INTERVAL
+        try:
+            records = await self.client.get_payment_records(
+                modified_since=None if full else delta_since(synced_at)
+            )
+        except Exception as e:
+            PAYMENTS_REPLICA_EVENTS.inc("sync_error")
+            logger.error(f"Не удалось синхронизировать реплику оплат: {e}")
+            return
+        new_meta = {"synced_at": started_at}
+        if full:
+            new_meta["full_synced_at"] = started_at
+        await asyncio.to_thread(
+            self._upsert, records, new_meta, started_at - SYNC_OVERLAP if full else None
+        )
+        PAYMENTS_REPLICA_EVENTS.inc("sync_full" if full else "sync_delta")
+        if full:
+            logger.info(f"Реплика оплат выгружена полностью: {len(records)} шт.")
+        elif records:
+            logger.info(f"Реплика оплат обновлена: изменено {len(records)}")
+
+    async def sync(self):
+        await self._syncer.run()
+
+    def start(self, interval: int = PAYMENTS_SYNC_INTERVAL):
+        """Запускает фоновую синхронизацию (первая — сразу, не задерживая запуск бота)."""
+        self._syncer.start(interval, immediately=True)
+
+    async def stop(self):
+        await self._syncer.stop()
+        await asyncio.to_thread(self._close)
@@ -0,0 +1,85 @@
+# bot/rate_limiter.py
+import asyncio
+import heapq
+import itertools
+import time
+from typing import Dict, List, Optional, Tuple
+from .config import AIRTABLE_RATE_LIMIT, AIRTABLE_RATE_BURST
+
+# Классы приоритета: меньше — раньше. Записи оплат идут впереди фоновой синхронизации заказов
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+
+class RateLimiter:
+    """Token bucket с очередью ожидающих по приоритету.
+
+    Один экземпляр на процесс ограничивает все запросы к базе Airtable,
+    а pause() останавливает выдачу токенов после ответа 429.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self.stats: Dict[str, int] = {
+            "acquired": 0,
+            "throttled": 0,
+            "retried": 0,
+            "rate_limited": 0
+        }
+
+    def _refill(self, now: float):
+        # Во время паузы _updated указывает в будущее — токены не копятся
+        if now > self._updated:
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+    def _dispatch(self):
+        self._timer = None
+        now = time.monotonic()
+        self._refill(now)
+        if now >= self._paused_until:
+            while self._waiters and self._tokens >= 1:
+                _, _, future = heapq.heappop(self._waiters)
+                if future.done():
+                    continue
+                future.set_result(None)
+                self._tokens -= 1
+        # Убираем отменённых ожидающих с вершины очереди
+        while self._waiters and self._waiters[0][2].done():
+            heapq.heappop(self._waiters)
+        if self._waiters:
+            delay = max((1 - self._tokens) / self.rate, self._paused_until - now, 0.0)
+            self._timer = asyncio.get_running_loop().call_later(delay, self._dispatch)
+
+    async def acquire(self, priority: int = PRIORITY_INTERACTIVE):
+        now = time.monotonic()
+        self._refill(now)
+        self.stats["acquired"] += 1
+        if not self._waiters and now >= self._paused_until and self._tokens >= 1:
+            self._tokens -= 1
+            return
+        self.stats["throttled"] += 1
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        if self._timer is not None:
+            self._timer.cancel()
+        self._dispatch()
+        await future
+
+    def pause(self, seconds: float):
+        """Не выдавать токены ближайшие seconds секунд (Airtable ответил 429)."""
+        self.stats["rate_limited"] += 1
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+        self._updated = self._paused_until
+
+
+# Общий на процесс лимитер для всех запросов к Airtable
+airtable_limiter = RateLimiter(AIRTABLE_RATE_LIMIT, AIRTABLE_RATE_BURST)
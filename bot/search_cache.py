@@ -0,0 +1,71 @@
+# bot/search_cache.py
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Generic, Hashable, Optional, TypeVar
+from .metrics import SEARCH_CACHE_EVENTS
+
+V = TypeVar("V")
+
+
+def normalize_query(query: str) -> str:
+    """Ключ запроса: нижний регистр и одиночные пробелы ("  АОС-0125  Окна" → "аос-0125 окна")."""
+    return " ".join(query.lower().split())
+
+
+class LRUCache(Generic[V]):
+    """Кэш с вытеснением давно не использованных записей и сроком жизни записи.
+
+    Размер считается в записях или, если задан weigh, в сумме их весов
+    (например, числе заказов в сохранённых списках). Попадания и промахи
+    учитываются в метрике bot_search_cache_total с меткой name.
+    """
+
+    def __init__(self, name: str, max_size: int, ttl: Optional[float] = None,
+                 weigh: Optional[Callable[[Any], int]] = None):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.weigh = weigh
+        self.size = 0
+        # Ключ → (значение, вес, когда истекает)
+        self._items: "OrderedDict[Hashable, tuple]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def get(self, key: Hashable) -> Optional[V]:
+        item = self._items.get(key)
+        if item is None:
+            SEARCH_CACHE_EVENTS.inc(self.name, "miss")
+            return None
+        value, weight, expires_at = item
+        if expires_at is not None and time.monotonic() >= expires_at:
+            self._remove(key)
+            SEARCH_CACHE_EVENTS.inc(self.name, "expired")
+            SEARCH_CACHE_EVENTS.inc(self.name, "miss")
+            return None
+        self._items.move_to_end(key)
+        SEARCH_CACHE_EVENTS.inc(self.name, "hit")
+        return value
+
+    def put(self, key: Hashable, value: V):
+        weight = self.weigh(value) if self.weigh else 1
+        if weight > self.max_size:
+            # Запись больше всего кэша — вытеснила бы всё остальное
+            return
+        if key in self._items:
+            self._remove(key)
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        self._items[key] = (value, weight, expires_at)
+        self.size += weight
+        while self.size > self.max_size:
+            self._remove(next(iter(self._items)))
+            SEARCH_CACHE_EVENTS.inc(self.name, "evicted")
+
+    def clear(self):
+        self._items.clear()
+        self.size = 0
+
+    def _remove(self, key: Hashable):
+        _, weight, _ = self._items.pop(key)
+        self.size -= weight
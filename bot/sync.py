@@ -0,0 +1,61 @@
+# bot/sync.py
+import asyncio
+from typing import Awaitable, Callable, Optional
+
+# Запас по времени для дельта-синхронизации (расхождение часов с Airtable)
+SYNC_OVERLAP = 60
+
+
+def delta_since(synced_at: float) -> float:
+    """Начало дельты для modified_since.
+
+    Водяной знак synced_at — момент начала прошлого запроса: всё изменённое
+    позже попадает в следующую дельту, а SYNC_OVERLAP покрывает расхождение часов.
+    """
+    return synced_at - SYNC_OVERLAP
+
+
+class BackgroundSync:
+    """Фоновая синхронизация с Airtable: одна задача на всех и периодический запуск.
+
+    Single-flight: пока идёт одна синхронизация, новые не запускаются —
+    вызывающие ждут уже идущую.
+    """
+
+    def __init__(self, run: Callable[[], Awaitable[None]]):
+        self._run = run
+        self._task: Optional[asyncio.Task] = None
+        self._periodic_task: Optional[asyncio.Task] = None
+
+    def schedule(self) -> asyncio.Task:
+        """Запускает синхронизацию, если она ещё не идёт, и возвращает её задачу."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        return self._task
+
+    async def run(self):
+        """Ждёт синхронизацию; отмена ожидающего не отменяет её саму."""
+        await asyncio.shield(self.schedule())
+
+    async def _run_periodically(self, interval: int, immediately: bool):
+        if not immediately:
+            await asyncio.sleep(interval)
+        while True:
+            await self.run()
+            await asyncio.sleep(interval)
+
+    def start(self, interval: int, immediately: bool = False):
+        """Запускает синхронизацию раз в interval секунд (immediately — первую сразу)."""
+        if interval > 0 and (self._periodic_task is None or self._periodic_task.done()):
+            self._periodic_task = asyncio.create_task(self._run_periodically(interval, immediately))
+
+    async def stop(self):
+        for task in (self._periodic_task, self._task):
+            if task is not None and not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._periodic_task = None
+        self._task = None
@@ -0,0 +1,105 @@
+# bot/update_queue.py
+import asyncio
+import logging
+import time
+from typing import Any, Dict, List, Tuple
+from aiohttp import web
+from aiogram import Bot
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from .metrics import UPDATE_QUEUE_WAIT
+from .config import UPDATE_WORKERS, UPDATE_QUEUE_SIZE, UPDATE_QUEUE_PUT_TIMEOUT
+
+# Сколько секунд при остановке ждать обработки уже принятых обновлений
+DRAIN_TIMEOUT = 10
+
+logger = logging.getLogger(__name__)
+
+
+def update_chat_id(update: Dict[str, Any]) -> int:
+    """Чат (или пользователь), к которому относится обновление, — для сохранения порядка."""
+    for key, event in update.items():
+        if key == "update_id" or not isinstance(event, dict):
+            continue
+        chat = event.get("chat") or (event.get("message") or {}).get("chat")
+        if chat and "id" in chat:
+            return chat["id"]
+        sender = event.get("from") or event.get("user")
+        if sender and "id" in sender:
+            return sender["id"]
+    return 0
+
+
+class QueuedRequestHandler(SimpleRequestHandler):
+    """Webhook-обработчик, который сразу отвечает Telegram и кладёт обновление
+    в ограниченную очередь.
+
+    Очередь разбита на UPDATE_WORKERS частей по chat_id: обновления одного чата
+    всегда попадают к одному обработчику и выполняются по порядку. Если очередь
+    заполнена дольше UPDATE_QUEUE_PUT_TIMEOUT секунд, Telegram получает 503 и
+    повторит доставку позже.
+    """
+
+    def __init__(self, *args, workers: int = UPDATE_WORKERS, queue_size: int = UPDATE_QUEUE_SIZE, **kwargs):
+        super().__init__(*args, handle_in_background=True, **kwargs)
+        shard_size = max(1, queue_size // workers)
+        self._queues: List[asyncio.Queue] = [asyncio.Queue(maxsize=shard_size) for _ in range(workers)]
+        self._workers: List[asyncio.Task] = []
+        # Время ожидания в очереди — в гистограмме bot_update_queue_wait_seconds
+        self.stats: Dict[str, int] = {
+            "enqueued": 0,
+            "processed": 0,
+            "failed": 0,
+            "rejected": 0
+        }
+
+    def register(self, app: web.Application, /, path: str, **kwargs: Any) -> None:
+        app.on_startup.append(self._start_workers)
+        super().register(app, path=path, **kwargs)
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(queue.qsize() for queue in self._queues)
+
+    async def _start_workers(self, *args: Any) -> None:
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._worker(queue)) for queue in self._queues]
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            bot, update, enqueued_at = await queue.get()
+            UPDATE_QUEUE_WAIT.observe(time.monotonic() - enqueued_at)
+            try:
+                await self._background_feed_update(bot=bot, update=update)
+                self.stats["processed"] += 1
+            except Exception as e:
+                self.stats["failed"] += 1
+                logger.error(f"Ошибка при обработке обновления {update.get('update_id')}: {e}", exc_info=True)
+            finally:
+                queue.task_done()
+
+    async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+        update = await request.json(loads=bot.session.json_loads)
+        queue = self._queues[hash(update_chat_id(update)) % len(self._queues)]
+        item: Tuple[Bot, Dict[str, Any], float] = (bot, update, time.monotonic())
+        try:
+            await asyncio.wait_for(queue.put(item), timeout=UPDATE_QUEUE_PUT_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.stats["rejected"] += 1
+            logger.warning(f"Очередь обновлений переполнена ({self.queue_depth}), обновление {update.get('update_id')} отклонено")
+            return web.Response(status=503, text="Update queue is full")
+        self.stats["enqueued"] += 1
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+    async def close(self) -> None:
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(queue.join() for queue in self._queues)),
+                timeout=DRAIN_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            logger.warning(f"Не дождались обработки {self.queue_depth} обновлений при остановке")
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        await super().close()
@@ -0,0 +1,42 @@
+# tests/test_payment_import.py
+import os
+import unittest
+
+# bot.config требует токены при импорте; разбору сумм они не нужны
+for _name in (
+    "TELEGRAM_BOT_TOKEN", "AIRTABLE_API_KEY", "AIRTABLE_BASE_ID", "AIRTABLE_TABLE_ID", "AIRTABLE_ORDERS_TABLE_ID"
+):
+    os.environ.setdefault(_name, "test")
+
+from bot.payment_import import parse_amount  # noqa: E402
+
+
+class ParseAmountTest(unittest.TestCase):
+    def test_amounts(self):
+        cases = {
+            "1 234,56 руб.": 1234.56,
+            "2.500,00 руб.": 2500.0,
+            "1,234": 1234.0,
+            "1.234.567": 1234567.0,
+            "1,234.56": 1234.56,
+            "1234.56 ₽": 1234.56,
+            "1 234 567,89": 1234567.89,
+            "1,5": 1.5,
+            "1 000": 1000.0,
+            "12.5.": 12.5,
+            "500 2024": 500.0,
+            1500: 1500.0,
+            99.9: 99.9
+        }
+        for value, expected in cases.items():
+            with self.subTest(value=value):
+                self.assertEqual(parse_amount(value), expected)
+
+    def test_not_amounts(self):
+        for value in ("", None, "руб.", "-500", "0,00", 0, -10):
+            with self.subTest(value=value):
+                self.assertIsNone(parse_amount(value))
+
+
+if __name__ == "__main__":
+    unittest.main()